@@ -1,63 +1,84 @@
 from .utils import *
+from .admet_journal import iter_journal
+from .admet_request import is_valid_mol
+from .admet_schema import (get_response_groups, get_result_columns, get_result_groups, to_compact, write_compact,
+                           RENAMED_COLUMNS)
+from .exceptions import NoMoleculeError, AdmetSchemaError
 import pandas as pd
 
 
 class AdmetAnalyzer:
-    def __init__(self, output_folder_path: str, best_molecules_dict: dict, list_mol: list):
+    def __init__(self, output_folder_path: str, best_molecules_dict: dict, journal_path: str):
         self.output_folder_path = output_folder_path
-        self.admet_df = pd.DataFrame(list_mol)
-        self._selected_columns()
-        self.admet_df = self.admet_df.rename(columns={'id': 'Molecule ID', 'smiles': 'SMILES', 'Synth': 'SA-score'})
+        self.journal_path = journal_path
+        self.admet_df = None
+        self.invalid_ids = set()
+        self.groups = None
+        self._response_columns = None
         self.results_path = f"{output_folder_path}/results"
         self.best_molecules_dict = best_molecules_dict
 
-    def _selected_columns(self):
-        all_columns = self.admet_df.columns.tolist()
-        final_columns = ['id']
-        metabolism = all_columns[54:68]
-        excretion = all_columns[68:70]
-        distribution = all_columns[45:54]
-        absortion = all_columns[36:45]
-        medicinal = all_columns[15:29]
-        medicinal_2 = ['Aggregators', 'Fluc',
-                       'Blue_fluorescence', 'Green_fluorescence', 'Reactive', 'Promiscuous']
-        medicinal.extend(medicinal_2)
-        toxi_rules = ['NonBiodegradable', 'NonGenotoxic_Carcinogenicity', 'SureChEMBL', 'Skin_Sensitization',
-                      'Acute_Aquatic_Toxicity',
-                      'Toxicophores', 'Genotoxic_Carcinogenicity_Mutagenicity']
-        toxicity = all_columns[70:94]
-        tox21 = all_columns[94:106]
-        smiles = all_columns[0]
-        final_columns.extend(medicinal)
-        final_columns.extend(absortion)
-        final_columns.extend(distribution)
-        final_columns.extend(metabolism)
-        final_columns.extend(excretion)
-        final_columns.extend(toxi_rules)
-        final_columns.extend(toxicity)
-        final_columns.extend(tox21)
-        final_columns.append(smiles)
-        self.admet_df = self.admet_df[final_columns]
+    def _read_journal(self):
+        """Read the admetlab journal chunk by chunk, keeping only the selected columns of the valid molecules
+        of this run, in the order of best_molecules_dict"""
+        frames = []
+        for mol_list in iter_journal(self.journal_path):
+            mol_list = [mol for mol in mol_list if mol['id'] in self.best_molecules_dict]
+            self.invalid_ids.update(mol['id'] for mol in mol_list if not is_valid_mol(mol))
+            mol_list = [mol for mol in mol_list if is_valid_mol(mol)]
+            if mol_list:
+                frames.append(self._selected_columns(pd.DataFrame(mol_list)))
+        if not frames:
+            raise NoMoleculeError("No valid molecule in the admetlab results")
+        admet_df = pd.concat(frames, ignore_index=True).drop_duplicates('id')
+        position = {key: i for i, key in enumerate(self.best_molecules_dict)}
+        admet_df = admet_df.iloc[admet_df['id'].map(position).argsort(kind='stable')].reset_index(drop=True)
+        self.admet_df = admet_df.rename(columns=RENAMED_COLUMNS)
+
+    def _selected_columns(self, admet_df: pd.DataFrame):
+        """Columns of the results table, checking the columns against the ADMET schema once per layout"""
+        columns = admet_df.columns.tolist()
+        if columns != self._response_columns:
+            groups = get_response_groups(columns)
+            if self.groups is not None and groups != self.groups:
+                raise AdmetSchemaError("The admetlab results in the journal have different columns")
+            self.groups = groups
+            self._response_columns = columns
+        return admet_df[get_result_columns(self.groups)]
 
     def _get_score_and_rmsd(self):
-        score = []
-        rmsd = []
-        for molecule_id in self.admet_df['Molecule ID']:
-            for key, value in self.best_molecules_dict.items():
-                if molecule_id == key:
-                    score.append(value['score'])
-                    rmsd.append(value['rmsd'])
-        self.admet_df['Score Pharmit'] = score
-        self.admet_df['RMSD Pharmit'] = rmsd
-        self.admet_df['Molecule ID'] = self.admet_df['Molecule ID'].str.split(' ', n=1, expand=True)[0]
+        """Join the pharmit score and RMSD to the admetlab results by Molecule ID"""
+        pharmit_df = pd.DataFrame.from_dict(self.best_molecules_dict, orient='index', columns=['score', 'rmsd'])
+        self.admet_df['Score Pharmit'] = self.admet_df['Molecule ID'].map(pharmit_df['score'])
+        self.admet_df['RMSD Pharmit'] = self.admet_df['Molecule ID'].map(pharmit_df['rmsd'])
+        self.admet_df['Molecule ID'] = self.admet_df['Molecule ID'].str.split(' ', n=1).str[0]
         cols = ['Molecule ID'] + [col for col in self.admet_df if col != 'Molecule ID']
         self.admet_df = self.admet_df[cols]
 
+    def _report_dropped(self):
+        """Write the molecules without admetlab results to admet_dropped.csv: invalid for admetlab or skipped
+        after admetlab kept failing on them. Returns how many were dropped"""
+        found_ids = set(self.admet_df['Molecule ID'])
+        dropped = [(key, mol_data['smiles'], 'Invalid Molecule' if key in self.invalid_ids else 'No prediction')
+                   for key, mol_data in self.best_molecules_dict.items() if key not in found_ids]
+        if dropped:
+            pd.DataFrame(dropped, columns=['Molecule ID', 'SMILES', 'Reason']).to_csv(
+                f'{self.results_path}/admet_dropped.csv', index=False)
+        return len(dropped)
+
     def run_admet_analyzer(self):
+        self._read_journal()
+        num_dropped = self._report_dropped()
         self._get_score_and_rmsd()
         best_score = self.admet_df['Score Pharmit'].min()
         num_molecules = self.admet_df.shape[0]
+        if num_dropped:
+            write_stats(f"\n\nMolecules dropped by admetlab (see admet_dropped.csv): {num_dropped}",
+                        self.output_folder_path)
         write_stats(f"\n\nNumber of molecules after admet filter: {num_molecules}\n"
                     f"Best score after admet research: {best_score}", self.output_folder_path)
 
         self.admet_df.to_csv(f'{self.results_path}/admet_filtered.csv', index=False)
+        result_groups = get_result_groups(self.groups)
+        write_compact(to_compact(self.admet_df, result_groups), result_groups,
+                      f'{self.results_path}/admet_filtered.parquet')
@@ -0,0 +1,90 @@
+"""Load benchmark of the ADMET stage: drives the admetlab client of admet_request against the local fake server
+of admet_fake_server, for each combination of client settings"""
+import asyncio
+import itertools
+import time
+import click
+import numpy as np
+import pandas as pd
+from . import admet_request
+from .admet_fake_server import FakeAdmetServer
+
+
+def generate_smiles(count: int):
+    """count different valid SMILES: chains of C, N, O and S spelling the index in base 4"""
+    return [f"C{''.join('CNOS'[int(digit)] for digit in np.base_repr(i, 4))}C" for i in range(count)]
+
+
+async def benchmark_config(server: FakeAdmetServer, smiles_list: list, concurrency: int, batch_size: int,
+                           adaptive: bool):
+    """Run the client once against a fresh fake server and return its throughput, latencies and retries"""
+    admet_request.set_admet_url(await server.start())
+    received = []
+    scheduler_params = {'batch_size': batch_size, 'backoff_base': 0.1, 'breaker_pause': 1.0,
+                        'show_progress': False}
+    if not adaptive:
+        scheduler_params.update(min_batch_size=batch_size, max_batch_size=batch_size)
+    items = [(f"Molecule_{i + 1}", smiles) for i, smiles in enumerate(smiles_list)]
+    start = time.monotonic()
+    try:
+        scheduler = await admet_request._run_admet_batches(items, concurrency, received.extend, **scheduler_params)
+    finally:
+        elapsed = time.monotonic() - start
+        await server.stop()
+    latencies = np.array(scheduler.latencies) * 1000
+    return {'concurrency': concurrency,
+            'batch_size': batch_size,
+            'adaptive': adaptive,
+            'molecules': len(received),
+            'seconds': round(elapsed, 2),
+            'mol/s': round(len(received) / elapsed, 1),
+            'requests': len(latencies),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 1),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 1),
+            'retries': scheduler.retries,
+            'skipped': len(scheduler.skipped),
+            'final_batch_size': scheduler.batch_size}
+
+
+@click.command()
+@click.option("-n", "--molecules", type=click.IntRange(min=1), default=2000, help="Number of SMILES to send")
+@click.option("--smiles", "smiles_file", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="File with a list of SMILES to send instead of the generated ones")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), multiple=True, default=(1, 5, 10),
+              help="Requests in flight (can be repeated)")
+@click.option("-b", "--batch_size", type=click.IntRange(min=1), multiple=True, default=(20,),
+              help="Initial SMILES per request (can be repeated)")
+@click.option("--fixed", is_flag=True, help="Keep the batch size fixed instead of adapting it")
+@click.option("--latency", type=float, default=0.2, help="Seconds the fake server spends on each request")
+@click.option("--latency_per_mol", type=float, default=0.01,
+              help="Seconds the fake server spends on each molecule of a request")
+@click.option("--jitter", type=float, default=0.05, help="Maximum random seconds added to each request")
+@click.option("--error_rate", type=float, default=0.0, help="Chance of a request failing with HTTP 500")
+@click.option("--capacity", type=float, default=None, help="Molecules the fake server predicts per second")
+@click.option("--max_inflight", type=int, default=None,
+              help="Requests the fake server handles at the same time, the others get 503")
+@click.option("--csv", "csv_path", type=click.Path(dir_okay=False), default=None, help="Save the results to a csv file")
+def admet_benchmark(molecules, smiles_file, concurrency, batch_size, fixed, latency, latency_per_mol, jitter,
+                    error_rate, capacity, max_inflight, csv_path):
+    """Benchmark the admetlab client against a local fake admetlab 3.0 server"""
+    if smiles_file:
+        with open(smiles_file, 'r') as f:
+            smiles_list = [line.strip() for line in f if line.strip()]
+    else:
+        smiles_list = generate_smiles(molecules)
+    results = []
+    for concurrency_value, batch_size_value in itertools.product(concurrency, batch_size):
+        server = FakeAdmetServer(latency, latency_per_mol, jitter, error_rate, capacity=capacity,
+                                 max_inflight=max_inflight)
+        results.append(asyncio.run(benchmark_config(server, smiles_list, concurrency_value, batch_size_value,
+                                                    not fixed)))
+        click.echo(f"concurrency {concurrency_value}, batch size {batch_size_value}: "
+                   f"{results[-1]['mol/s']} mol/s")
+    results_df = pd.DataFrame(results)
+    click.echo(f"\n{results_df.to_string(index=False)}")
+    if csv_path:
+        results_df.to_csv(csv_path, index=False)
+
+
+if __name__ == "__main__":
+    admet_benchmark()
@@ -0,0 +1,106 @@
+import json
+import os
+import sqlite3
+import time
+from rdkit import Chem
+
+ADMETLAB_API_VERSION = 'admetlab3'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pharmisa')
+CACHE_FILE_NAME = 'admet_cache.sqlite'
+SQLITE_MAX_VARIABLES = 900
+
+
+def canonical_smiles(smiles: str):
+    """RDKit canonical SMILES, the SMILES itself if RDKit can't parse it.
+    The RDKit logger is left alone: silence it around the whole batch with rdBase.BlockLogs()"""
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return smiles
+    return Chem.MolToSmiles(mol)
+
+
+class AdmetCache:
+    """SQLite cache of the admetlab predictions of each molecule, keyed by canonical SMILES and API version.
+    Stores the molecule dict of the admetlab response without the Molecule ID"""
+    def __init__(self, cache_path: str = None, version: str = ADMETLAB_API_VERSION):
+        self.cache_path = cache_path or os.path.join(CACHE_DIR, CACHE_FILE_NAME)
+        self.version = version
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.cache_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                smiles TEXT NOT NULL,
+                version TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (smiles, version)
+            );
+            CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+        """)
+        self.connection.commit()
+
+    def get_many(self, smiles_list: list):
+        """Cached predictions of the canonical SMILES in smiles_list, as a dict canonical SMILES -> molecule dict"""
+        keys = list(dict.fromkeys(smiles_list))
+        found = {}
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            chunk = keys[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT smiles, response FROM predictions WHERE version = ? AND smiles IN ({placeholders})",
+                [self.version, *chunk])
+            found.update((smiles, json.loads(response)) for smiles, response in rows)
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("UPDATE predictions SET last_used = ? WHERE smiles = ? AND version = ?",
+                                        [(now, smiles, self.version) for smiles in found])
+            self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'hits'", (len(found),))
+            self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'misses'",
+                                    (len(keys) - len(found),))
+        return found
+
+    def put_many(self, predictions: dict):
+        """Save a dict canonical SMILES -> molecule dict"""
+        now = time.time()
+        rows = []
+        for smiles, mol in predictions.items():
+            response = json.dumps({key: value for key, value in mol.items() if key != 'id'})
+            rows.append((smiles, self.version, response, len(response), now))
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)", rows)
+
+    def stats(self):
+        entries, size = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM predictions").fetchone()
+        counters = dict(self.connection.execute("SELECT name, value FROM counters"))
+        lookups = counters['hits'] + counters['misses']
+        return {'path': self.cache_path,
+                'entries': entries,
+                'size_mb': size / 1024 ** 2,
+                'file_size_mb': os.path.getsize(self.cache_path) / 1024 ** 2,
+                'hits': counters['hits'],
+                'misses': counters['misses'],
+                'hit_rate': counters['hits'] / lookups if lookups else 0.0}
+
+    def prune(self, max_size_mb: float):
+        """Remove the least recently used predictions until the cached responses fit in max_size_mb.
+        Returns the number of predictions removed"""
+        max_size = max_size_mb * 1024 ** 2
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+        to_remove = []
+        rows = self.connection.execute("SELECT rowid, size FROM predictions ORDER BY last_used").fetchall()
+        for rowid, size in rows:
+            if total_size <= max_size:
+                break
+            to_remove.append((rowid,))
+            total_size -= size
+        with self.connection:
+            self.connection.executemany("DELETE FROM predictions WHERE rowid = ?", to_remove)
+        self.connection.execute("VACUUM")
+        return len(to_remove)
+
+    def close(self):
+        self.connection.close()
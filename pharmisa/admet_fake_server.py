@@ -0,0 +1,171 @@
+"""Local stand-in for the admetlab 3.0 /api/admet endpoint, to benchmark and test the ADMET stage offline.
+Run it with python -m pharmisa.admet_fake_server and point pharmisa to it with
+PHARMISA_ADMET_URL=http://localhost:8000/api/admet"""
+import asyncio
+import random
+import time
+import zlib
+import click
+from aiohttp import web
+from rdkit import Chem, rdBase
+
+PHYSCHEM_COLUMNS = ['MW', 'Vol', 'Dense', 'nHA', 'nHD', 'TPSA', 'nRot', 'nRing', 'MaxRing', 'nHet', 'fChar', 'nRig',
+                    'Flex', 'nStereo']
+MEDICINAL_COLUMNS = ['QED', 'Synth', 'gasa', 'Fsp3', 'MCE-18', 'Natural Product-likeness', 'Alarm_NMR', 'BMS',
+                     'Chelating', 'PAINS', 'Lipinski', 'Pfizer', 'GSK', 'GoldenTriangle']
+ASSAY_COLUMNS = ['Aggregators', 'Fluc', 'Blue_fluorescence', 'Green_fluorescence', 'Reactive', 'Promiscuous',
+                 'Other_assay_interference']
+ABSORPTION_COLUMNS = ['caco2', 'MDCK', 'PAMPA', 'pgp_inh', 'pgp_sub', 'hia', 'f20', 'f30', 'f50']
+DISTRIBUTION_COLUMNS = ['PPB', 'logVDss', 'BBB', 'Fu', 'OATP1B1', 'OATP1B3', 'BCRP', 'BSEP', 'MRP1']
+METABOLISM_COLUMNS = ['CYP1A2-inh', 'CYP1A2-sub', 'CYP2C19-inh', 'CYP2C19-sub', 'CYP2C9-inh', 'CYP2C9-sub',
+                      'CYP2D6-inh', 'CYP2D6-sub', 'CYP3A4-inh', 'CYP3A4-sub', 'CYP2B6-inh', 'CYP2B6-sub',
+                      'CYP2C8-inh', 'LM-human']
+EXCRETION_COLUMNS = ['cl-plasma', 't0.5']
+TOXICITY_COLUMNS = ['hERG', 'hERG-10um', 'DILI', 'Ames', 'ROA', 'FDAMDD', 'SkinSen', 'Carcinogenicity', 'EC', 'EI',
+                    'Respiratory', 'H-HT', 'Neurotoxicity-DI', 'Ototoxicity', 'Hematotoxicity', 'Nephrotoxicity-DI',
+                    'Genotoxicity', 'RPMI-8226', 'A549', 'HEK293', 'BCF', 'IGC50', 'LC50DM', 'LC50FM']
+TOX21_COLUMNS = ['NR-AR', 'NR-AR-LBD', 'NR-AhR', 'NR-Aromatase', 'NR-ER', 'NR-ER-LBD', 'NR-PPAR-gamma', 'SR-ARE',
+                 'SR-ATAD5', 'SR-HSE', 'SR-MMP', 'SR-p53']
+TOXICITY_RULES_COLUMNS = ['NonBiodegradable', 'NonGenotoxic_Carcinogenicity', 'SureChEMBL', 'Skin_Sensitization',
+                          'Acute_Aquatic_Toxicity', 'Toxicophores', 'Genotoxic_Carcinogenicity_Mutagenicity']
+PROPERTY_COLUMNS = ['logS', 'logD7.4', 'logP', 'mp', 'bp', 'pka_acidic', 'pka_basic']
+# Same order as the admetlab 3.0 response
+ADMETLAB_COLUMNS = (['smiles'] + PHYSCHEM_COLUMNS + MEDICINAL_COLUMNS + ASSAY_COLUMNS + ABSORPTION_COLUMNS +
+                    DISTRIBUTION_COLUMNS + METABOLISM_COLUMNS + EXCRETION_COLUMNS + TOXICITY_COLUMNS + TOX21_COLUMNS +
+                    TOXICITY_RULES_COLUMNS + PROPERTY_COLUMNS)
+ALERT_COLUMNS = ['Alarm_NMR', 'BMS', 'Chelating', 'PAINS'] + TOXICITY_RULES_COLUMNS
+RULE_COLUMNS = ['gasa', 'Lipinski', 'Pfizer', 'GSK', 'GoldenTriangle']
+VALUE_RANGES = {'MW': (150, 650), 'Vol': (150, 650), 'Dense': (0.7, 1.3), 'TPSA': (10, 160), 'fChar': (-2, 2),
+                'Flex': (0, 1.5), 'Synth': (1, 7), 'MCE-18': (0, 120), 'Natural Product-likeness': (-3, 3),
+                'caco2': (-7, -4), 'MDCK': (-7, -4), 'PPB': (20, 100), 'logVDss': (-1, 2), 'Fu': (0, 60),
+                'cl-plasma': (0, 20), 't0.5': (0, 10), 'BCF': (0, 3), 'IGC50': (1, 6), 'LC50DM': (2, 7),
+                'LC50FM': (2, 7), 'logS': (-8, 0), 'logD7.4': (-2, 6), 'logP': (-2, 7), 'mp': (50, 300),
+                'bp': (200, 600), 'pka_acidic': (0, 14), 'pka_basic': (0, 14)}
+COUNT_COLUMNS = ['nHA', 'nHD', 'nRot', 'nRing', 'MaxRing', 'nHet', 'nRig', 'nStereo']
+ALERT_NAMES = ['Michael_acceptor', 'Aldehyde', 'Thiol', 'Nitro', 'Azo', 'Epoxide', 'Catechol', 'Quinone']
+
+
+def predict(smiles: str):
+    """Fake but deterministic admetlab prediction of one SMILES, 'Invalid Molecule' if RDKit can't parse it"""
+    with rdBase.BlockLogs():
+        mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return {column: smiles if column == 'smiles' else 'Invalid Molecule' for column in ADMETLAB_COLUMNS}
+    rng = random.Random(zlib.crc32(smiles.encode()))
+    prediction = {}
+    for column in ADMETLAB_COLUMNS:
+        if column == 'smiles':
+            value = smiles
+        elif column in ALERT_COLUMNS:
+            alerts = rng.sample(ALERT_NAMES, rng.choice([0, 0, 0, 1, 2]))
+            value = str(alerts or ['-'])
+        elif column in RULE_COLUMNS:
+            value = rng.choice([0, 0, 1])
+        elif column in COUNT_COLUMNS:
+            value = rng.randint(0, 12)
+        elif column in VALUE_RANGES:
+            value = round(rng.uniform(*VALUE_RANGES[column]), 3)
+        else:
+            value = round(rng.random(), 3)
+        prediction[column] = value
+    return prediction
+
+
+class FakeAdmetServer:
+    """aiohttp app answering POST /api/admet like admetlab 3.0:
+    {"SMILES": [...], "feature": false} -> {"data": {"data": [one dict per SMILES]}}
+    latency + latency_per_mol * batch size (+ up to jitter) is the time spent on each request.
+    error_rate is the chance of a request failing with HTTP 500, malformed_rate the chance of an HTTP 200 answer
+    without the predictions ({"data": null}), and a batch with one of the poison SMILES always fails. capacity
+    limits the molecules predicted per second (requests wait for their turn) and max_inflight the requests handled
+    at the same time (the others get HTTP 503)"""
+    def __init__(self, latency: float = 0.0, latency_per_mol: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, poison: tuple = (), capacity: float = None, max_inflight: int = None,
+                 seed: int = 0, malformed_rate: float = 0.0):
+        self.latency = latency
+        self.latency_per_mol = latency_per_mol
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.poison = set(poison)
+        self.capacity = capacity
+        self.max_inflight = max_inflight
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'molecules': 0, 'errors': 0, 'rejected': 0, 'malformed': 0}
+        self._inflight = 0
+        self._capacity_free_at = 0.0
+        self._runner = None
+
+    async def _wait_capacity(self, molecules: int):
+        """Requests are served in turn, capacity molecules per second"""
+        if not self.capacity:
+            return
+        now = time.monotonic()
+        start = max(now, self._capacity_free_at)
+        self._capacity_free_at = start + molecules / self.capacity
+        await asyncio.sleep(self._capacity_free_at - now)
+
+    async def handle_admet(self, request: web.Request):
+        self.stats['requests'] += 1
+        if self.max_inflight and self._inflight >= self.max_inflight:
+            self.stats['rejected'] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        self._inflight += 1
+        try:
+            smiles_list = (await request.json())['SMILES']
+            await self._wait_capacity(len(smiles_list))
+            await asyncio.sleep(self.latency + self.latency_per_mol * len(smiles_list) +
+                                self.random.uniform(0, self.jitter))
+            if self.random.random() < self.error_rate or not self.poison.isdisjoint(smiles_list):
+                self.stats['errors'] += 1
+                return web.Response(status=500, text="Internal Server Error")
+            if self.random.random() < self.malformed_rate:
+                self.stats['malformed'] += 1
+                return web.json_response({'code': 200, 'data': None})
+            self.stats['molecules'] += len(smiles_list)
+            return web.json_response({'code': 200, 'data': {'data': [predict(smiles) for smiles in smiles_list]}})
+        finally:
+            self._inflight -= 1
+
+    def get_app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post('/api/admet', self.handle_admet)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        """Start serving in the running event loop and return the url of the endpoint"""
+        self._runner = web.AppRunner(self.get_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/api/admet"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+@click.command()
+@click.option("--host", default='127.0.0.1', help="Address to listen on")
+@click.option("--port", type=int, default=8000, help="Port to listen on")
+@click.option("--latency", type=float, default=0.5, help="Seconds spent on each request")
+@click.option("--latency_per_mol", type=float, default=0.05, help="Seconds spent on each molecule of a request")
+@click.option("--jitter", type=float, default=0.2, help="Maximum random seconds added to each request")
+@click.option("--error_rate", type=float, default=0.0, help="Chance of a request failing with HTTP 500")
+@click.option("--malformed_rate", type=float, default=0.0,
+              help="Chance of a request answered with HTTP 200 but without the predictions")
+@click.option("--poison", multiple=True, help="SMILES that makes its whole request fail (can be repeated)")
+@click.option("--capacity", type=float, default=None, help="Molecules predicted per second")
+@click.option("--max_inflight", type=int, default=None, help="Requests handled at the same time, the others get 503")
+def admet_fake_server(host, port, latency, latency_per_mol, jitter, error_rate, malformed_rate, poison, capacity,
+                      max_inflight):
+    """Serve a fake admetlab 3.0 /api/admet endpoint"""
+    server = FakeAdmetServer(latency, latency_per_mol, jitter, error_rate, poison, capacity, max_inflight,
+                             malformed_rate=malformed_rate)
+    click.echo(f"Fake admetlab 3.0 at http://{host}:{port}/api/admet")
+    web.run_app(server.get_app(), host=host, port=port, print=None)
+
+
+if __name__ == "__main__":
+    admet_fake_server()
@@ -0,0 +1,69 @@
+import json
+import os
+
+JOURNAL_FILE_NAME = 'admet_journal.jsonl'
+JOURNAL_CHUNK_SIZE = 5000
+JOURNAL_TAIL_SIZE = 1 << 16
+
+
+def get_journal_path(output_folder_path: str):
+    return os.path.join(output_folder_path, 'results', JOURNAL_FILE_NAME)
+
+
+def iter_journal(journal_path: str, chunk_size: int = JOURNAL_CHUNK_SIZE):
+    """Yield the molecule dicts of the journal in lists of up to chunk_size.
+    A line cut by a crash while it was being written is ignored"""
+    if not os.path.isfile(journal_path):
+        return
+    chunk = []
+    with open(journal_path, 'r') as journal:
+        for line in journal:
+            if not line.endswith('\n'):
+                break
+            chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_journal_ids(journal_path: str):
+    return {mol['id'] for chunk in iter_journal(journal_path) for mol in chunk}
+
+
+class AdmetJournal:
+    """Append-only JSONL file in the results folder with one admetlab molecule dict (with its id) per line,
+    written as each batch arrives so an interrupted ADMET analysis can be resumed"""
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self._drop_partial_line()
+        self.journal = open(journal_path, 'a')
+
+    def _drop_partial_line(self):
+        """Truncate the line cut by a crash, if any, after the last line break of the journal.
+        The journal is read backwards from its end in blocks, so only its tail is read"""
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, 'rb+') as journal:
+            end = position = journal.seek(0, os.SEEK_END)
+            while position > 0:
+                start = max(0, position - JOURNAL_TAIL_SIZE)
+                journal.seek(start)
+                block = journal.read(position - start)
+                if position == end and block.endswith(b'\n'):
+                    return
+                line_break = block.rfind(b'\n')
+                if line_break != -1:
+                    journal.truncate(start + line_break + 1)
+                    return
+                position = start
+            journal.truncate(0)
+
+    def append(self, mol_list: list):
+        for mol in mol_list:
+            self.journal.write(json.dumps(mol) + '\n')
+        self.journal.flush()
+
+    def close(self):
+        self.journal.close()
@@ -1,14 +1,36 @@
+import asyncio
+import os
+import aiohttp
 import requests
-from concurrent.futures import ThreadPoolExecutor
 import urllib3
-import time
+from rdkit import rdBase
 from tqdm import tqdm
+from .utils import process_smiles_file
+from .exceptions import AdmetBusyError
+from .admet_cache import AdmetCache, canonical_smiles
+from .admet_scheduler import AdmetScheduler
+from .admet_journal import AdmetJournal, read_journal_ids
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 protocol = "https"
 url = f"https://admetlab3.scbdd.com/api/admet"
 SSL = True
+ADMET_CONCURRENCY = 5
+REQUEST_TIMEOUT = 300
+custom_url = False
+
+
+def set_admet_url(new_url: str):
+    """Send the requests to another server with the admetlab 3.0 API, like the one of admet_fake_server"""
+    global protocol
+    global url
+    global SSL
+    global custom_url
+    protocol = new_url.split(':', 1)[0]
+    url = new_url
+    SSL = protocol == "https"
+    custom_url = True
 
 
 def check_ssl():
@@ -16,6 +38,8 @@ def check_ssl():
     global protocol
     global url
     global SSL
+    if custom_url:
+        return
     try:
         requests.get(url, verify=True)
     except requests.exceptions.SSLError:
@@ -25,45 +49,127 @@ def check_ssl():
     url = f"{protocol}://admetlab3.scbdd.com/api/admet"
 
 
-def get_smiles_sublist(best_molecules_dict: dict):
-    smiles_tuple_list = [(key, mol_data['smiles']) for key, mol_data in best_molecules_dict.items()]
-    if len(smiles_tuple_list) > 20:
-        num_sublists = (len(smiles_tuple_list) + 19) // 20
-        smiles_sublists = [smiles_tuple_list[i*20:(i+1)*20] for i in range(num_sublists)]
-    else:
-        smiles_sublists = [smiles_tuple_list]
-    return smiles_sublists
+def read_mol_list(response: dict, ids_list: list):
+    """Molecules of an admetlab response with their ids. Raises ValueError if the response is not
+    {"data": {"data": [one dict per SMILES]}}"""
+    data = response.get('data') if isinstance(response, dict) else None
+    mol_list = data.get('data') if isinstance(data, dict) else None
+    if not isinstance(mol_list, list) or not all(isinstance(mol, dict) for mol in mol_list):
+        raise ValueError(f"Unexpected admetlab 3.0 response: {str(response)[:200]}")
+    if len(mol_list) != len(ids_list):
+        raise ValueError(f"Admetlab 3.0 returned {len(mol_list)} molecules for {len(ids_list)} SMILES")
+    for mol, key in zip(mol_list, ids_list):
+        mol['id'] = key
+    return mol_list
+
+
+def is_valid_mol(mol: dict):
+    return 'Invalid Molecule' not in mol.values()
 
 
-def get_mol_list(smiles_sublist: list):
-    """Get url for csv file generated by the admetlab portal for the smiles"""
-    global url
-    global SSL
+async def get_mol_list(session: aiohttp.ClientSession, smiles_sublist: list):
+    """Get the admetlab 3.0 predictions for the smiles"""
     smiles_list = [smiles for key, smiles in smiles_sublist]
     ids_list = [key for key, smiles in smiles_sublist]
     payload = {
         "SMILES": smiles_list,
         "feature": False
     }
-    r = requests.post(url, json=payload, verify=SSL)
-    if r.status_code == 503 or r.status_code == 500:
-        raise ConnectionError("Admetlab 3.0 Is Unavailable or Encountered an Error")
-    else:
-        response = r.json()
-    mol_list = response['data']['data']
-    for mol, key in zip(mol_list, ids_list):
-        mol['id'] = key
-    mol_list = [mol for mol in mol_list if 'Invalid Molecule' not in mol.values()]
-    time.sleep(0.2)
-    return mol_list
+    async with session.post(url, json=payload, ssl=SSL) as r:
+        if r.status in (429, 503):
+            raise AdmetBusyError(f"Admetlab 3.0 Is Unavailable (HTTP {r.status})")
+        if r.status != 200:
+            raise ConnectionError(f"Admetlab 3.0 Is Unavailable or Encountered an Error (HTTP {r.status})")
+        response = await r.json(content_type=None)
+    return read_mol_list(response, ids_list)
+
+
+async def _run_admet_batches(smiles_list: list, concurrency: int, on_results, **scheduler_params):
+    """Send the (key, smiles) pairs through one pooled session, with the batching of AdmetScheduler.
+    on_results gets the molecule dicts of each batch as it arrives. Returns the scheduler, with the keys admetlab
+    kept failing on in scheduler.skipped"""
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        scheduler = AdmetScheduler(lambda batch: get_mol_list(session, batch), concurrency, on_results=on_results,
+                                   **scheduler_params)
+        await scheduler.run(smiles_list)
+    if scheduler.skipped:
+        tqdm.write(f"{len(scheduler.skipped)} molecules skipped after admetlab 3.0 failed on them: "
+              f"{', '.join(scheduler.skipped)}")
+    return scheduler
+
+
+def _get_cached(best_molecules_dict: dict, cache: AdmetCache):
+    """Canonical SMILES of each key, the cached predictions and the keys of the molecules that are not cached,
+    grouped by canonical SMILES so each structure is sent to admetlab only once"""
+    with rdBase.BlockLogs():
+        cache_keys = {key: canonical_smiles(mol_data['smiles']) for key, mol_data in best_molecules_dict.items()}
+    cached = {}
+    if cache:
+        cached = cache.get_many(list(cache_keys.values()))
+        tqdm.write(f"{sum(cache_key in cached for cache_key in cache_keys.values())} of {len(cache_keys)} "
+              f"molecules found in the ADMET cache")
+    missing_groups = {}
+    for key, cache_key in cache_keys.items():
+        if cache_key not in cached:
+            missing_groups.setdefault(cache_key, []).append(key)
+    missing_count = sum(len(keys) for keys in missing_groups.values())
+    if missing_count > len(missing_groups):
+        tqdm.write(f"{missing_count} molecules share {len(missing_groups)} unique SMILES, "
+              f"{missing_count - len(missing_groups)} admetlab predictions saved")
+    return cache_keys, cached, missing_groups
+
+
+def _get_missing_smiles_list(best_molecules_dict: dict, missing_groups: dict):
+    """One (key, smiles) pair for each unique SMILES, with the first key of its group"""
+    return [(keys[0], best_molecules_dict[keys[0]]['smiles']) for keys in missing_groups.values()]
+
+
+def run_admet_request(best_molecules_dict: dict, journal_path: str, concurrency: int = ADMET_CONCURRENCY,
+                      cache: AdmetCache = None):
+    """Append the admetlab predictions of the molecules to the journal as they arrive and return its path.
+    Molecules already in the journal (from an interrupted run) are not sent again, nor the ones in the cache.
+    Molecules with the same canonical SMILES are sent once and the prediction is copied to all their ids, each with
+    its own SMILES"""
+    done_ids = read_journal_ids(journal_path)
+    pending_dict = {key: mol_data for key, mol_data in best_molecules_dict.items() if key not in done_ids}
+    if len(pending_dict) < len(best_molecules_dict):
+        tqdm.write(f"Resuming the ADMET analysis: {len(best_molecules_dict) - len(pending_dict)} of "
+              f"{len(best_molecules_dict)} molecules already in {journal_path}")
+    journal = AdmetJournal(journal_path)
+    try:
+        cache_keys, cached, missing_groups = _get_cached(pending_dict, cache)
+        journal.append([{**cached[cache_key], 'id': key, 'smiles': pending_dict[key]['smiles']}
+                        for key, cache_key in cache_keys.items() if cache_key in cached])
+
+        def save_results(mol_list: list):
+            journal.append([{**mol, 'id': key, 'smiles': pending_dict[key]['smiles']}
+                            for mol in mol_list for key in missing_groups[cache_keys[mol['id']]]])
+            if cache:
+                cache.put_many({cache_keys[mol['id']]: mol for mol in mol_list})
+
+        if missing_groups:
+            check_ssl()
+            asyncio.run(_run_admet_batches(_get_missing_smiles_list(pending_dict, missing_groups), concurrency,
+                                           save_results))
+    finally:
+        journal.close()
+    return journal_path
+
+
+def warm_admet_cache(smiles_file_path: str, cache: AdmetCache, concurrency: int = ADMET_CONCURRENCY):
+    """Send the SMILES of a file (one per line) that are not cached yet to admetlab, saving the predictions.
+    Returns the number of SMILES already cached and the number sent"""
+    smiles_dict = process_smiles_file(smiles_file_path)
+    cache_keys, cached, missing_groups = _get_cached(smiles_dict, cache)
+    if missing_groups:
+        check_ssl()
+        asyncio.run(_run_admet_batches(_get_missing_smiles_list(smiles_dict, missing_groups), concurrency,
+                                       lambda mol_list: cache.put_many({cache_keys[mol['id']]: mol
+                                                                        for mol in mol_list})))
+    return len(smiles_dict) - sum(len(keys) for keys in missing_groups.values()), len(missing_groups)
 
 
-def run_admet_request(best_molecules_dict: dict):
-    check_ssl()
-    smiles_strings = get_smiles_sublist(best_molecules_dict)
-    final_mol_list = []
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        for smiles_sublist in tqdm(smiles_strings, desc="Getting ADMET info", ncols=100):
-            response = executor.submit(get_mol_list, smiles_sublist)
-            final_mol_list.extend(response.result())
-    return final_mol_list
+if os.environ.get('PHARMISA_ADMET_URL'):
+    set_admet_url(os.environ['PHARMISA_ADMET_URL'])
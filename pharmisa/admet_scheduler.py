@@ -0,0 +1,179 @@
+import asyncio
+import aiohttp
+import random
+import time
+from collections import deque
+from tqdm import tqdm
+from .exceptions import AdmetServerError, AdmetBusyError
+
+BATCH_SIZE = 20
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 50
+TARGET_LATENCY = 30.0
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+BREAKER_THRESHOLD = 8
+BREAKER_PAUSE = 60.0
+MAX_PAUSES = 5
+
+
+class AdmetScheduler:
+    """Sends (key, smiles) pairs to admetlab in batches, with up to concurrency batches in flight.
+    - The batch size grows by one while the batches answer under target_latency and is halved on slow
+      answers and errors (AIMD)
+    - A failing batch is split in half and retried after an exponential backoff with jitter, so a SMILES that
+      breaks the server ends up alone and is skipped after max_retries. A batch refused with 429/503 (server busy)
+      is retried whole, after the same backoff. A batch waiting for its backoff doesn't hold a worker: the workers
+      send the batches that are due and the new items meanwhile
+    - After breaker_threshold failures in a row all requests pause for breaker_pause seconds (doubling each time)
+      instead of aborting the run. AdmetServerError is raised after max_pauses pauses without a success
+    The results of each batch go to on_results as they arrive, or to self.results if it is None"""
+    def __init__(self, send_batch, concurrency: int, batch_size: int = BATCH_SIZE,
+                 min_batch_size: int = MIN_BATCH_SIZE, max_batch_size: int = MAX_BATCH_SIZE,
+                 target_latency: float = TARGET_LATENCY, max_retries: int = MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE, backoff_max: float = BACKOFF_MAX,
+                 breaker_threshold: int = BREAKER_THRESHOLD, breaker_pause: float = BREAKER_PAUSE,
+                 max_pauses: int = MAX_PAUSES, on_results=None, show_progress: bool = True):
+        self.send_batch = send_batch
+        self.on_results = on_results
+        self.show_progress = show_progress
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_pause = breaker_pause
+        self.max_pauses = max_pauses
+        self.results = {}
+        self.skipped = []
+        self.retries = 0
+        self.latencies = []
+        self._items = deque()
+        self._retry_batches = deque()
+        self._remaining = 0
+        self._consecutive_failures = 0
+        self._pauses = 0
+        self._paused_until = 0.0
+        self._progress = None
+        self._changed = None
+
+    def _next_batch(self):
+        """The first batch whose retry is due, else the next batch_size new items.
+        None if the only batches left are still backing off"""
+        now = time.monotonic()
+        for index, (not_before, batch, attempts) in enumerate(self._retry_batches):
+            if not_before <= now:
+                del self._retry_batches[index]
+                return batch, attempts
+        if not self._items:
+            return None
+        batch = [self._items.popleft() for _ in range(min(self.batch_size, len(self._items)))]
+        return batch, 0
+
+    def _next_retry_delay(self):
+        """Seconds until the first retry is due, None if no batch is waiting for a retry"""
+        if not self._retry_batches:
+            return None
+        return max(0.0, min(not_before for not_before, batch, attempts in self._retry_batches) - time.monotonic())
+
+    async def _wait_breaker(self):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def _on_success(self, batch: list, mol_list: list, latency: float):
+        self._consecutive_failures = 0
+        self._pauses = 0
+        if latency < self.target_latency:
+            self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+        else:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        if self.on_results:
+            self.on_results(mol_list)
+        else:
+            for mol in mol_list:
+                self.results[mol['id']] = mol
+        self._done(len(batch))
+
+    def _on_failure(self, batch: list, attempts: int, error: Exception):
+        """Queue the batch, or its halves, to be retried once its backoff delay is over"""
+        self.retries += 1
+        self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.breaker_threshold:
+            self._consecutive_failures = 0
+            self._pauses += 1
+            if self._pauses > self.max_pauses:
+                raise AdmetServerError(f"Admetlab 3.0 kept failing after {self.max_pauses} pauses: {error}")
+            pause = self.breaker_pause * 2 ** (self._pauses - 1)
+            self._paused_until = time.monotonic() + pause
+            tqdm.write(f"Admetlab 3.0 is failing ({error}), pausing the requests for {pause:.0f} s")
+            # The server is down, not the batch: retry it as it is, after the pause
+            self._retry_batches.appendleft((0.0, batch, attempts))
+            return
+        not_before = time.monotonic() + random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempts))
+        if isinstance(error, AdmetBusyError):
+            # The server refused the request, not the SMILES: retry the same batch later
+            self._retry_batches.append((not_before, batch, attempts + 1))
+        elif len(batch) > 1:
+            half = len(batch) // 2
+            self._retry_batches.appendleft((not_before, batch[half:], attempts + 1))
+            self._retry_batches.appendleft((not_before, batch[:half], attempts + 1))
+        elif attempts < self.max_retries or self._pauses:
+            # During an outage every SMILES fails, it is only skipped once the server answers the others again
+            self._retry_batches.appendleft((not_before, batch, attempts + 1))
+        else:
+            tqdm.write(f"Skipping {batch[0][0]}, admetlab 3.0 failed on its SMILES {batch[0][1]}")
+            self.skipped.append(batch[0][0])
+            self._done(1)
+
+    def _done(self, count: int):
+        self._remaining -= count
+        self._progress.update(count)
+
+    async def _worker(self):
+        while True:
+            async with self._changed:
+                while (next_batch := self._next_batch()) is None:
+                    if self._remaining == 0:
+                        return
+                    # Wake up when another worker queues a batch or when the first retry is due
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), self._next_retry_delay())
+                    except asyncio.TimeoutError:
+                        pass
+                batch, attempts = next_batch
+            await self._wait_breaker()
+            start = time.monotonic()
+            try:
+                mol_list = await self.send_batch(batch)
+            except (ConnectionError, OSError, aiohttp.ClientError, asyncio.TimeoutError, ValueError,
+                    KeyError) as error:
+                self.latencies.append(time.monotonic() - start)
+                self._on_failure(batch, attempts, error)
+            else:
+                self.latencies.append(time.monotonic() - start)
+                self._on_success(batch, mol_list, self.latencies[-1])
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def run(self, items: list):
+        """Predictions of the (key, smiles) items as a dict key -> molecule dict (empty with on_results).
+        The keys of the skipped molecules are in self.skipped"""
+        self._items.extend(items)
+        self._remaining = len(items)
+        self._changed = asyncio.Condition()
+        with tqdm(total=len(items), desc="Getting ADMET info", ncols=100,
+                  disable=not self.show_progress) as self._progress:
+            workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for worker in workers:
+                    worker.cancel()
+                raise
+        return self.results
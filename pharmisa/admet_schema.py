@@ -0,0 +1,136 @@
+import json
+from ast import literal_eval
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+from .exceptions import AdmetSchemaError
+
+# Columns of each group of the admetlab 3.0 response, picked by name
+RESPONSE_GROUPS = {
+    'physchem': ['MW', 'Vol', 'Dense', 'nHA', 'nHD', 'TPSA', 'nRot', 'nRing', 'MaxRing', 'nHet', 'fChar', 'nRig',
+                 'Flex', 'nStereo'],
+    'medicinal': ['QED', 'Synth', 'gasa', 'Fsp3', 'MCE-18', 'Natural Product-likeness', 'Alarm_NMR', 'BMS',
+                  'Chelating', 'PAINS', 'Lipinski', 'Pfizer', 'GSK', 'GoldenTriangle'],
+    'assay': ['Aggregators', 'Fluc', 'Blue_fluorescence', 'Green_fluorescence', 'Reactive', 'Promiscuous'],
+    'absorption': ['caco2', 'MDCK', 'PAMPA', 'pgp_inh', 'pgp_sub', 'hia', 'f20', 'f30', 'f50'],
+    'distribution': ['PPB', 'logVDss', 'BBB', 'Fu', 'OATP1B1', 'OATP1B3', 'BCRP', 'BSEP', 'MRP1'],
+    'metabolism': ['CYP1A2-inh', 'CYP1A2-sub', 'CYP2C19-inh', 'CYP2C19-sub', 'CYP2C9-inh', 'CYP2C9-sub', 'CYP2D6-inh',
+                   'CYP2D6-sub', 'CYP3A4-inh', 'CYP3A4-sub', 'CYP2B6-inh', 'CYP2B6-sub', 'CYP2C8-inh', 'LM-human'],
+    'excretion': ['cl-plasma', 't0.5'],
+    'toxicity': ['hERG', 'hERG-10um', 'DILI', 'Ames', 'ROA', 'FDAMDD', 'SkinSen', 'Carcinogenicity', 'EC', 'EI',
+                 'Respiratory', 'H-HT', 'Neurotoxicity-DI', 'Ototoxicity', 'Hematotoxicity', 'Nephrotoxicity-DI',
+                 'Genotoxicity', 'RPMI-8226', 'A549', 'HEK293', 'BCF', 'IGC50', 'LC50DM', 'LC50FM'],
+    'tox21': ['NR-AR', 'NR-AR-LBD', 'NR-AhR', 'NR-Aromatase', 'NR-ER', 'NR-ER-LBD', 'NR-PPAR-gamma', 'SR-ARE',
+              'SR-ATAD5', 'SR-HSE', 'SR-MMP', 'SR-p53'],
+    'toxicity_rules': ['NonBiodegradable', 'NonGenotoxic_Carcinogenicity', 'SureChEMBL', 'Skin_Sensitization',
+                       'Acute_Aquatic_Toxicity', 'Toxicophores', 'Genotoxic_Carcinogenicity_Mutagenicity'],
+}
+# Columns of the response that Pharmisa doesn't use
+UNUSED_COLUMNS = ['id', 'smiles', 'Other_assay_interference', 'logS', 'logD7.4', 'logP', 'mp', 'bp', 'pka_acidic',
+                  'pka_basic']
+# Groups of the results table, in order, between the Molecule ID and the SMILES
+RESULT_GROUPS = ['medicinal', 'assay', 'absorption', 'distribution', 'metabolism', 'excretion', 'toxicity_rules',
+                 'toxicity', 'tox21']
+RENAMED_COLUMNS = {'id': 'Molecule ID', 'smiles': 'SMILES', 'Synth': 'SA-score'}
+
+# Compact types: lists of structural alerts are stored as the number of alerts, the rules as categories.
+# The predictions stay float64: the Pharmisa Score and the report colors compare them with thresholds, and a
+# float32 value on a threshold crosses it (QED 0.67 is 0.6700000167 in float32)
+ALERT_COLUMNS = ['Alarm_NMR', 'BMS', 'PAINS', 'Chelating'] + RESPONSE_GROUPS['toxicity_rules']
+RULE_COLUMNS = ['Lipinski', 'Pfizer', 'GSK', 'GoldenTriangle']
+RULE_CATEGORIES = ['Accepted', 'Rejected']
+SYNTHESIS_COLUMNS = ['gasa']
+SYNTHESIS_CATEGORIES = ['Easy', 'Hard']
+SCHEMA_METADATA_KEY = b'pharmisa_groups'
+
+
+def get_response_groups(columns: list):
+    """Check the columns of an admetlab response against the schema and return the column names of each group.
+    Raises AdmetSchemaError if a column of the schema is missing, and reports the columns it doesn't know"""
+    missing = [column for column in ['id', 'smiles'] if column not in columns]
+    if missing:
+        raise AdmetSchemaError(f"Unexpected admetlab response without the {', '.join(missing)} column, with the "
+                               f"columns {', '.join(columns[:3])}...")
+    present = set(columns)
+    for group, group_columns in RESPONSE_GROUPS.items():
+        missing = [column for column in group_columns if column not in present]
+        if missing:
+            raise AdmetSchemaError(f"Columns {', '.join(missing)} of the {group} group are missing from the "
+                                   f"admetlab response")
+    known = set(UNUSED_COLUMNS).union(*RESPONSE_GROUPS.values())
+    unknown = [column for column in columns if column not in known]
+    if unknown:
+        tqdm.write(f"Ignoring the admetlab columns that Pharmisa doesn't know: {', '.join(unknown)}")
+    return {group: list(group_columns) for group, group_columns in RESPONSE_GROUPS.items()}
+
+
+def get_result_columns(groups: dict):
+    """Columns of the admetlab response kept in the results table, in order"""
+    return ['id'] + [column for group in RESULT_GROUPS for column in groups[group]] + ['smiles']
+
+
+def get_result_groups(groups: dict):
+    """Groups of the results table, with the renamed columns"""
+    return {group: [RENAMED_COLUMNS.get(column, column) for column in groups[group]] for group in RESULT_GROUPS}
+
+
+def count_alerts(alert_value):
+    """Number of structural alerts of a list like ['alert_1', 'alert_2'], 0 for ['-']"""
+    if isinstance(alert_value, (list, tuple)):
+        alert_value = str(list(alert_value))
+    if alert_value == "['-']":
+        return 0
+    try:
+        return len(literal_eval(alert_value))
+    except (SyntaxError, ValueError, TypeError):
+        return 0
+
+
+def count_alerts_column(alert_values: pd.Series):
+    """count_alerts of a whole column with string operations. Only the values that are not a plain list of quoted
+    names fall back to literal_eval"""
+    alert_strings = alert_values.astype(str)
+    counts = alert_strings.str.count("', '").to_numpy() + 1
+    counts[(alert_strings == '[]').to_numpy() | (alert_strings == "['-']").to_numpy()] = 0
+    plain = alert_strings.str.fullmatch(r"\[('[^',]*'(, '[^',]*')*)?\]").to_numpy()
+    if not plain.all():
+        counts[~plain] = alert_values[~plain].map(count_alerts).to_numpy()
+    return counts
+
+
+def to_compact(admet_df: pd.DataFrame, result_groups: dict):
+    """Results table with compact types: uint8 alert counts and categorical rules, float64 predictions"""
+    compact_df = admet_df.copy()
+    for column in (column for group in RESULT_GROUPS for column in result_groups[group]):
+        values = admet_df[column]
+        if column in ALERT_COLUMNS:
+            compact_df[column] = count_alerts_column(values).astype('uint8')
+        elif column in RULE_COLUMNS:
+            compact_df[column] = pd.Categorical(np.where(pd.to_numeric(values, errors='coerce') == 0, 'Accepted',
+                                                         'Rejected'), categories=RULE_CATEGORIES)
+        elif column in SYNTHESIS_COLUMNS:
+            compact_df[column] = pd.Categorical(np.where(pd.to_numeric(values, errors='coerce') == 0, 'Easy',
+                                                         'Hard'), categories=SYNTHESIS_CATEGORIES)
+        else:
+            try:
+                compact_df[column] = pd.to_numeric(values).astype('float64')
+            except (ValueError, TypeError):
+                raise AdmetSchemaError(f"Column {column} of the admetlab response is not numeric")
+    return compact_df
+
+
+def write_compact(compact_df: pd.DataFrame, result_groups: dict, parquet_path: str):
+    """Write the compact results table to parquet, with the groups of its columns in the metadata"""
+    table = pa.Table.from_pandas(compact_df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SCHEMA_METADATA_KEY] = json.dumps(result_groups).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), parquet_path)
+
+
+def read_compact(parquet_path: str):
+    """Compact results table and the groups of its columns"""
+    table = pq.read_table(parquet_path)
+    groups = json.loads(table.schema.metadata[SCHEMA_METADATA_KEY])
+    return table.to_pandas(), groups
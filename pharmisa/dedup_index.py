@@ -0,0 +1,46 @@
+from rdkit import Chem
+
+DEDUP_KEYS = ('smiles', 'canonical', 'inchikey')
+
+
+def molecule_key(mol, smiles: str, dedup_key: str = 'smiles'):
+    """Key used to tell two Pharmit hits apart:
+    smiles - the non-isomeric SMILES written to the results (default)
+    canonical - canonical isomeric SMILES, with the stereo read from the 3D coordinates
+    inchikey - standard InChIKey
+    Falls back to the SMILES if RDKit can't sanitize the molecule"""
+    if dedup_key == 'smiles':
+        return smiles
+    try:
+        mol = Chem.Mol(mol)
+        Chem.SanitizeMol(mol)
+        Chem.AssignStereochemistryFrom3D(mol)
+        if dedup_key == 'canonical':
+            return Chem.MolToSmiles(mol, isomericSmiles=True)
+        return Chem.MolToInchiKey(mol) or smiles
+    except (ValueError, RuntimeError):
+        return smiles
+
+
+class DedupIndex:
+    """Hash based index of the molecules already selected, by dedup key and by Molecule ID"""
+    def __init__(self, dedup_key: str = 'smiles'):
+        if dedup_key not in DEDUP_KEYS:
+            raise ValueError(f"Invalid dedup key: {dedup_key}. Use one of {', '.join(DEDUP_KEYS)}")
+        self.dedup_key = dedup_key
+        self.keys = set()
+        self.mol_ids = set()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def has_ids(self, mol_ids_set: set) -> bool:
+        """True if any of the ids was already selected"""
+        return not self.mol_ids.isdisjoint(mol_ids_set)
+
+    def add(self, key, mol_ids_set: set):
+        self.keys.add(key)
+        self.mol_ids.update(mol_ids_set)
@@ -12,3 +12,15 @@ class AdmetServerError(Exception):
 
 class NoMoleculeError(Exception):
     pass
+
+
+class AdmetBusyError(ConnectionError):
+    pass
+
+
+class AdmetSchemaError(Exception):
+    pass
+
+
+class FpadmetError(Exception):
+    pass
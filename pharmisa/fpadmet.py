@@ -1,87 +1,310 @@
+import heapq
+import itertools
+import math
+import os
+import queue
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from tqdm import tqdm
 from importlib.resources import path
+from .exceptions import FpadmetError
+
+FINGERPRINT_GENERATOR = 'FINGERPRINTER/FingerprintGenerator.jar'
+PREDICTION_WORKER = 'PREDICTORS/predict_worker.R'
+# Fingerprint type of each endpoint, as in runadmet.sh, and the model its PREDICTORS script reads
+ENDPOINTS = {
+    4: ('PUBCHEM', 'model_ames_pubchem.rds'),
+    6: ('PUBCHEM', 'model_acutetox_pubchem.rds'),
+    7: ('PUBCHEM', 'model_DILI_pubchem.rds'),
+    8: ('FCFP6', 'model_hergcardiotox_fcfp6.rds'),
+    10: ('FCFP4', 'model_myelotoxicity_fcfp4.rds'),
+    17: ('DFS', 'model_myopathy_dfs.rds'),
+    25: ('MACCS', 'model_resptox_maccs.rds'),
+    29: ('PUBCHEM', 'model_carcinogenecity_pubchem.rds'),
+    35: ('PUBCHEM', 'model_ototox_pubchem.rds'),
+    40: ('AT2D', 'model_hepg2_at2d.rds'),
+}
+TOX_PARAMETERS = [4, 6, 7, 8, 10, 17, 25, 29, 35, 40]
+# Fingerprint generators and R workers running at the same time
+FPADMET_WORKERS = 4
+# Number of molecules with the lowest FPADMET_Score that are kept
+FPADMET_TOP = 3500
+TOX_TO_NUMBER = {
+    'Predicted_4': {'active': 1, 'inactive': 0},
+    'Predicted_6': {'EPA1': 1, 'EPA2': 0.75, 'EPA3': 0.5, 'EPA4': 0},
+    'Predicted_7': {'P': 1, 'N': 0},
+    'Predicted_8': {'P': 1, 'N': 0},
+    'Predicted_10': {'Positive': 1, 'Negative': 0},
+    'Predicted_17': {'Positive': 1, 'Negative': 0},
+    'Predicted_25': {'Yes': 1, 'No': 0},
+    'Predicted_29': {'Carcinogen': 1, 'NonCarcinogen': 0},
+    'Predicted_35': {'Yes': 1, 'No': 0},
+    'Predicted_40': {'P': 1, 'N': 0}
+}
+
+
+def get_fpadmet_path():
+    with path('pharmisa', 'fpadmet') as fpadmet_path:
+        return fpadmet_path.resolve()
+
+
+def check_fpadmet_models(tox_parameters=TOX_PARAMETERS):
+    """Raises FpadmetError if the model of an endpoint is missing from fpadmet/MODELS"""
+    models_path = get_fpadmet_path().joinpath('MODELS')
+    missing = [ENDPOINTS[parameter][1] for parameter in tox_parameters
+               if not models_path.joinpath(ENDPOINTS[parameter][1]).is_file()]
+    if missing:
+        raise FpadmetError(f"The FPADMET models {', '.join(missing)} are missing from {models_path}")
 
 
 def create_fpadmet_input_file(dict_final, output_folder_path):
+    """Writes the SMILES of dict_final with a code for each molecule, returns the file and the key of each code"""
     smi_input_file_path = f'{output_folder_path}/fpadmet_smiles.smi'
+    code_index = {}
     with open(smi_input_file_path, 'w') as smi_f:
         for i, key in enumerate(dict_final, start=1):
             smiles = dict_final[key]['smiles']
-            smi_f.write(f'{smiles}\tG{str(i).zfill(5)}\n')
-    return smi_input_file_path
-
-
-def get_fpadmet_score(df):
-    tox_to_number = {
-        'Predicted_4': {'active': 1, 'inactive': 0},
-        'Predicted_6': {'EPA1': 1, 'EPA2': 0.75, 'EPA3': 0.5, 'EPA4': 0},
-        'Predicted_7': {'P': 1, 'N': 0},
-        'Predicted_8': {'P': 1, 'N': 0},
-        'Predicted_10': {'Positive': 1, 'Negative': 0},
-        'Predicted_17': {'Positive': 1, 'Negative': 0},
-        'Predicted_25': {'Yes': 1, 'No': 0},
-        'Predicted_29': {'Carcinogen': 1, 'NonCarcinogen': 0},
-        'Predicted_35': {'Yes': 1, 'No': 0},
-        'Predicted_40': {'P': 1, 'N': 0}
-    }
+            code = f'G{str(i).zfill(5)}'
+            code_index[code] = key
+            smi_f.write(f'{smiles}\t{code}\n')
+    return smi_input_file_path, code_index
+
+
+def add_fpadmet_score(df):
     all_columns = df.columns
     tox_columns = [col for col in all_columns if 'Predicted' in col]
     for col in tox_columns:
-        df[col] = df[col].map(tox_to_number[col])
+        df[col] = df[col].map(TOX_TO_NUMBER[col])
     df['FPADMET_Score'] = df[tox_columns].sum(axis=1)
-    df = df.sort_values('FPADMET_Score', ascending=True)
-    df = df.head(3500)
-    df.to_csv('fpadmet_results_sorted.csv')
     return df
 
 
-def get_new_dict_final(dict_final, smi_input_file, fpadmet_df):
-    smiles_dict = {}
-    with open(smi_input_file, 'r') as f:
-        for line in f:
-            smiles, code = line.strip().split('\t')
-            smiles_dict[code] = smiles
+def get_fpadmet_score(df, output_folder_path):
+    df = add_fpadmet_score(df)
+    # Ties keep the input order, as in run_chunked_fpadmet
+    df = df.sort_values('FPADMET_Score', ascending=True, kind='stable')
+    df = df.head(FPADMET_TOP)
+    df.to_csv(f'{output_folder_path}/results/fpadmet_results_sorted.csv')
+    return df
 
-    smiles_list = []
-    for code in fpadmet_df['Molecule']:
-        smiles = smiles_dict.get(code)
-        if smiles is not None:
-            smiles_list.append(smiles)
 
+def get_new_dict_final(dict_final, code_index, fpadmet_df):
+    """Keeps in dict_final only the molecules whose code is in the FPADMET results"""
+    kept_keys = {code_index[code] for code in fpadmet_df['Molecule'] if code in code_index}
     for key in dict_final.copy():
-        if dict_final[key]['smiles'] not in smiles_list:
+        if key not in kept_keys:
             dict_final.pop(key)
 
     return dict_final
 
 
-def run_loop_fpadmet(fpadmet_path, script_path, smi_input_file, tox_parameters):
-    results = []
-    for parameter in tqdm(tox_parameters, desc="Running FPADMET", ncols=100):
-        command = ["bash", script_path, "-f", smi_input_file, "-p", str(parameter)]
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        predicted_fpadmet = str(fpadmet_path.joinpath(f'RESULTS/predicted{parameter}.txt'))
-        df_temp = pd.read_csv(predicted_fpadmet, sep=' ', header=None, names=['Molecule', f'Predicted_{parameter}'])
-        df_temp.set_index('Molecule', inplace=True)  # Set 'Molecule' as index
-        results.append(df_temp)
+def compute_fingerprints(fpadmet_path, smi_input_file, fingerprint_types, scratch_path, workers=FPADMET_WORKERS,
+                         show_progress=True):
+    """Runs FingerprintGenerator once for each fingerprint type, at most workers at a time, and returns the
+    fingerprint file of each type in scratch_path"""
+    def compute_fingerprint(fingerprint_type):
+        fingerprint_file = os.path.join(scratch_path, f'fps_{fingerprint_type}.txt')
+        command = ['java', '-jar', FINGERPRINT_GENERATOR, '-output', fingerprint_file, '-fptype', fingerprint_type,
+                   '-mol', smi_input_file]
+        try:
+            subprocess.run(command, cwd=fpadmet_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            raise FpadmetError("java was not found, it is needed to compute the FPADMET fingerprints")
+        return fingerprint_file
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        fingerprint_files = list(tqdm(executor.map(compute_fingerprint, fingerprint_types),
+                                      total=len(fingerprint_types), desc="Computing fingerprints", ncols=100,
+                                      disable=not show_progress))
+    return dict(zip(fingerprint_types, fingerprint_files))
+
+
+def read_predictions(predicted_file, parameter):
+    """Predictions of an endpoint indexed by molecule code. The R table has a header with one field less than its
+    rows, that pandas reads as the index column"""
+    df_temp = pd.read_csv(predicted_file, sep=' ')
+    df_temp.index.name = 'Molecule'
+    return df_temp.rename(columns={'Predicted': f'Predicted_{parameter}'})
+
+
+class PredictionWorker:
+    """R process of predict_worker.R, that loads the R packages once and keeps each model loaded after its
+    first prediction"""
+    def __init__(self, fpadmet_path):
+        try:
+            self.process = subprocess.Popen(['Rscript', PREDICTION_WORKER], cwd=fpadmet_path,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                            text=True)
+        except FileNotFoundError:
+            raise FpadmetError("Rscript was not found, it is needed to run the FPADMET predictions")
+
+    def predict(self, model_file, fingerprint_file, predicted_file):
+        """Writes the predictions of a model for a fingerprint file. The model is in MODELS, the other paths are
+        absolute or relative to the fpadmet folder"""
+        try:
+            self.process.stdin.write(f'{model_file}\t{fingerprint_file}\t{predicted_file}\n')
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        answer = self.process.stdout.readline().strip()
+        if answer != 'done':
+            raise FpadmetError(f"The R prediction worker failed on {model_file}: {answer or 'worker exited'}")
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class PredictionPool:
+    """Up to workers R prediction workers, each running one endpoint at a time"""
+    def __init__(self, fpadmet_path, workers=FPADMET_WORKERS):
+        self.fpadmet_path = fpadmet_path
+        self.workers = workers
+        self.prediction_workers = []
+        self.idle_workers = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _get_worker(self):
+        try:
+            return self.idle_workers.get_nowait()
+        except queue.Empty:
+            # Each thread of the executor needs at most one worker, so there are never more than self.workers
+            worker = PredictionWorker(self.fpadmet_path)
+            self.prediction_workers.append(worker)
+            return worker
+
+    def _predict_endpoint(self, parameter, fingerprint_files, scratch_path):
+        fingerprint_type, model_file = ENDPOINTS[parameter]
+        endpoint_path = os.path.join(scratch_path, f'endpoint_{parameter}')
+        os.makedirs(endpoint_path, exist_ok=True)
+        predicted_file = os.path.join(endpoint_path, 'predicted.txt')
+        worker = self._get_worker()
+        try:
+            worker.predict(model_file, fingerprint_files[fingerprint_type], predicted_file)
+        finally:
+            self.idle_workers.put(worker)
+        return read_predictions(predicted_file, parameter)
+
+    def predict_endpoints(self, tox_parameters, fingerprint_files, scratch_path, show_progress=True):
+        """Predictions of each endpoint, in the order of tox_parameters. Each endpoint writes in its own folder of
+        scratch_path"""
+        futures = [self.executor.submit(self._predict_endpoint, parameter, fingerprint_files, scratch_path)
+                   for parameter in tox_parameters]
+        return [future.result() for future in tqdm(futures, desc="Running FPADMET", ncols=100,
+                                                   disable=not show_progress)]
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        for worker in self.prediction_workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def predict_smi_file(fpadmet_path, smi_file, tox_parameters, scratch_path, prediction_pool,
+                     workers=FPADMET_WORKERS, show_progress=True):
+    """Predictions of the endpoints for the molecules of a .smi file, with the files written in scratch_path"""
+    fingerprint_types = list(dict.fromkeys(ENDPOINTS[parameter][0] for parameter in tox_parameters))
+    fingerprint_files = compute_fingerprints(fpadmet_path, smi_file, fingerprint_types, scratch_path, workers,
+                                             show_progress)
+    results = prediction_pool.predict_endpoints(tox_parameters, fingerprint_files, scratch_path, show_progress)
     df = pd.concat(results, axis=1)
     df.reset_index(inplace=True)
-    df = df.iloc[1:]
-    df.to_csv('fpadmet_results.csv')
     return df
 
 
-def run_fpadmet(dict_final, output_folder_path):
-    with path('pharmisa', 'fpadmet') as fpadmet_path:
-        script_path = fpadmet_path.joinpath('runadmet.sh')
-        fpadmet_path = fpadmet_path.resolve()
-
-    smi_input_file = create_fpadmet_input_file(dict_final, output_folder_path)
-    tox_parameters = [4, 6, 7, 8, 10, 17, 25, 29, 35, 40]
-    fpadmet_df = run_loop_fpadmet(fpadmet_path, script_path, smi_input_file, tox_parameters)
-    fpadmet_df = get_fpadmet_score(fpadmet_df)
-    dict_final = get_new_dict_final(dict_final, smi_input_file, fpadmet_df)
+def run_loop_fpadmet(fpadmet_path, smi_input_file, tox_parameters, output_folder_path, workers=FPADMET_WORKERS):
+    # Scratch folder of this run, so that runs and endpoints never share their files
+    with tempfile.TemporaryDirectory(prefix='fpadmet_', dir=output_folder_path) as scratch_path:
+        with PredictionPool(fpadmet_path, workers) as prediction_pool:
+            df = predict_smi_file(fpadmet_path, smi_input_file, tox_parameters, scratch_path, prediction_pool,
+                                  workers)
+    df.to_csv(f'{output_folder_path}/results/fpadmet_results.csv')
+    return df
+
+
+def iter_smi_shards(smi_input_file, chunk_size, scratch_path):
+    """Splits a .smi file in shards of chunk_size molecules, each in its own folder of scratch_path that is removed
+    once the next shard is requested"""
+    with open(smi_input_file, 'r') as smi_f:
+        for shard_index in itertools.count():
+            lines = list(itertools.islice(smi_f, chunk_size))
+            if not lines:
+                return
+            shard_path = os.path.join(scratch_path, f'shard_{shard_index}')
+            os.makedirs(shard_path)
+            shard_file = os.path.join(shard_path, 'fpadmet_smiles.smi')
+            with open(shard_file, 'w') as shard_f:
+                shard_f.writelines(lines)
+            try:
+                yield shard_path, shard_file
+            finally:
+                shutil.rmtree(shard_path)
+
+
+def push_top(top_heap, df, top):
+    """Folds the scored molecules of a shard into top_heap, which keeps the top molecules with the lowest
+    FPADMET_Score, the first ones in the input on ties. The heap root is the worst of them"""
+    if len(top_heap) == top:
+        df = df[df['FPADMET_Score'] <= -top_heap[0][0]]
+    for position, row in zip(df.index, df.itertuples(index=False, name=None)):
+        entry = (-row[-1], -position, row)
+        if len(top_heap) < top:
+            heapq.heappush(top_heap, entry)
+        elif entry > top_heap[0]:
+            heapq.heapreplace(top_heap, entry)
+
+
+def run_chunked_fpadmet(fpadmet_path, smi_input_file, tox_parameters, output_folder_path, chunk_size,
+                        molecule_count, workers=FPADMET_WORKERS):
+    """Predicts the molecules in shards of chunk_size, keeping only the FPADMET_TOP with the lowest FPADMET_Score,
+    so that memory and scratch files don't grow with the number of molecules"""
+    results_path = f'{output_folder_path}/results/fpadmet_results.csv'
+    top_heap = []
+    columns = None
+    position = 0
+    with tempfile.TemporaryDirectory(prefix='fpadmet_', dir=output_folder_path) as scratch_path:
+        with PredictionPool(fpadmet_path, workers) as prediction_pool:
+            shards = iter_smi_shards(smi_input_file, chunk_size, scratch_path)
+            for shard_path, shard_file in tqdm(shards, total=math.ceil(molecule_count / chunk_size),
+                                               desc="Running FPADMET in shards", ncols=100):
+                df = predict_smi_file(fpadmet_path, shard_file, tox_parameters, shard_path, prediction_pool,
+                                      workers, show_progress=False)
+                df.index = range(position, position + len(df))
+                df.to_csv(results_path, mode='w' if columns is None else 'a', header=columns is None)
+                df = add_fpadmet_score(df)
+                columns = df.columns
+                push_top(top_heap, df, FPADMET_TOP)
+                position += len(df)
+    top_entries = sorted(top_heap, reverse=True)
+    df = pd.DataFrame([row for *_, row in top_entries], columns=columns, index=[-entry[1] for entry in top_entries])
+    df.to_csv(f'{output_folder_path}/results/fpadmet_results_sorted.csv')
+    return df
+
+
+def run_fpadmet(dict_final, output_folder_path, workers=FPADMET_WORKERS, chunk_size=None):
+    check_fpadmet_models()
+    fpadmet_path = get_fpadmet_path()
+
+    smi_input_file, code_index = create_fpadmet_input_file(dict_final, output_folder_path)
+    smi_input_file = os.path.abspath(smi_input_file)
+    if chunk_size:
+        fpadmet_df = run_chunked_fpadmet(fpadmet_path, smi_input_file, TOX_PARAMETERS, output_folder_path,
+                                         chunk_size, len(dict_final), workers)
+    else:
+        fpadmet_df = run_loop_fpadmet(fpadmet_path, smi_input_file, TOX_PARAMETERS, output_folder_path, workers)
+        fpadmet_df = get_fpadmet_score(fpadmet_df, output_folder_path)
+    dict_final = get_new_dict_final(dict_final, code_index, fpadmet_df)
 
     return dict_final
@@ -1,323 +1,399 @@
+import html
+import json
+from importlib.resources import files
 import pandas as pd
 import numpy as np
-from ast import literal_eval
-
-
-def define_globals(df):
-    global no_color_columns, normal_values_columns, medicinal_rules_columns, columns_to_clean, strange_columns, \
-        thresholds
-    all_columns = df.columns.tolist()
-    no_color_columns = ['Molecule ID', 'SMILES', 'Score Pharmit', 'RMSD Pharmit', 'Alarm_NMR', 'BMS', 'Chelating',
-                        'PAINS', 'Natural Product-likeness', 't0.5', 'CYP1A2-inh', 'CYP1A2-sub', 'CYP2C19-inh',
-                        'CYP2C19-sub', 'CYP2C9-inh', 'CYP2C9-sub', 'CYP2D6-inh', 'CYP2D6-sub', 'CYP3A4-inh',
-                        'CYP3A4-sub', 'CYP2B6-inh', 'CYP2B6-sub', 'CYP2C8-inh', 'IGC50', 'LC50DM', 'LC50FM', 'BCF',
-                        'NonBiodegradable', 'NonGenotoxic_Carcinogenicity', 'SureChEMBL', 'Skin_Sensitization',
-                        'Acute_Aquatic_Toxicity', 'Toxicophores', 'Genotoxic_Carcinogenicity_Mutagenicity']
-    columns_to_clean = ['Alarm_NMR', 'BMS', 'PAINS', 'Chelating', 'NonBiodegradable', 'NonGenotoxic_Carcinogenicity',
-                        'SureChEMBL', 'Skin_Sensitization', 'Acute_Aquatic_Toxicity', 'Toxicophores',
-                        'Genotoxic_Carcinogenicity_Mutagenicity']
-    strange_columns = ['QED', 'Fsp3', 'MCE-18', 'SA-score', 'caco2', 'cl-plasma']
-    normal_values_columns = all_columns[15:21]
-    normal_values_columns.extend(all_columns[22:30])
-    normal_values_columns.extend(all_columns[66:86])
-    normal_values_columns.extend(all_columns[86:98])
-    normal_values_columns.extend(['Pharmisa Score', 'toxicity_score', 'medicinal_score', 'absortion_score',
-                                  'distribution_score', 'metabolism_score', 'excretion_score', 'tox21_score'])
-    normal_values_columns.remove('MDCK')
-
-    medicinal_rules_columns = all_columns[11:15]
-    medicinal_rules_columns.extend(['gasa'])
-
-    thresholds = {
-        'QED': (0.67, 0.67),
-        'Fsp3': (0.42, 0.42),
-        'MCE-18': (45, 45),
-        'SA-score': (6, 6),
-        'caco2': (-5.15, -5.15),
-        'cl-plasma': (5, 15),
-        't0.5': (1, 8),
-    }
-
-
-# Defining the globals
-df_old = pd.DataFrame()
-no_color_columns, normal_values_columns, medicinal_rules_columns, columns_to_clean, strange_columns = [], [], [], [], []
-thresholds = {}
-
-
-def color_format(column):
-    """Color formatting for the DataFrame."""
-    global no_color_columns, normal_values_columns, medicinal_rules_columns, strange_columns
-    column_name = column.name
-    color = None
-    if column_name in no_color_columns:
-        return ['background-color: default' for _ in column]
-    elif column_name in normal_values_columns:
-        color = column.apply(
-            lambda val: '#58D68D' if 0 <= float(val) <= 0.3 else ('#F4D03F' if 0.3 < float(val) <= 0.7 else '#EC7063'))
-    elif column_name in medicinal_rules_columns:
-        color = column.apply(lambda val: '#58D68D' if val in ['Accepted', 'Easy'] else '#EC7063')
-    elif column_name in strange_columns:
-        if column_name == 'QED':
-            color = column.apply(lambda val: '#58D68D' if float(val) > 0.67 else '#EC7063')
-        if column_name == 'Fsp3':
-            color = column.apply(lambda val: '#58D68D' if float(val) >= 0.42 else '#EC7063')
-        if column_name == 'MCE-18':
-            color = column.apply(lambda val: '#58D68D' if float(val) >= 45 else '#EC7063')
-        if column_name == 'SA-score':
-            color = column.apply(lambda val: '#58D68D' if float(val) <= 6 else '#EC7063')
-        if column_name == 'caco2':
-            color = column.apply(lambda val: '#58D68D' if float(val) > -5.15 else '#EC7063')
-        if column_name == 'cl-plasma':
-            color = column.apply(lambda val: '#58D68D' if 0 < float(val) <= 5 else ('#F4D03F' if 5 < float(val) <= 15
-                                                                                    else '#EC7063'))
-    else:
-        return ['background-color: default' for _ in column]
-
-    color = color.apply(lambda val: f'background-color: {val}' if isinstance(val, str) else 'background-color: default')
-    return color
-
-
-def get_df_html(df_html_old: pd.DataFrame):
-    """Get the DataFrame with the desired columns and format."""
-    global columns_to_clean
-    global medicinal_rules_columns
-
-    for column in medicinal_rules_columns:
-        if column == 'gasa':
-            df_html_old[column] = df_html_old[column].apply(clean_medicinal_columns, rules=False)
-        else:
-            df_html_old[column] = df_html_old[column].apply(clean_medicinal_columns)
-    for column in columns_to_clean:
-        df_html_old[column] = df_html_old[column].apply(clean_lists_columns)
-    df_html = get_toxicity_score(df_html_old)
-    df_html = get_medicinal_score(df_html)
-    df_html = get_absortion_score(df_html)
-    df_html = get_distribution_score(df_html)
-    df_html = get_metabolism_score(df_html)
-    df_html = get_excretion_score(df_html)
-    df_html = get_tox21_score(df_html)
-    df_html = get_pharmisa_score(df_html)
-    df_html = df_html.sort_values(by='Pharmisa Score', ascending=True)
-    df_html = df_html.reset_index(drop=True)
-    first_columns = ['Molecule ID', 'Pharmisa Score', 'toxicity_score', 'medicinal_score',
-                     'absortion_score', 'distribution_score', 'metabolism_score', 'excretion_score', 'tox21_score']
-    rest_of_columns = [col for col in df_html.columns if col not in first_columns]
-    df_html = df_html[first_columns + rest_of_columns]
-    df_html['smiles-res'] = df_html['SMILES']
-    df_html = df_html.drop(columns=['SMILES'], axis=1)
-    df_html['SMILES'] = df_html['smiles-res']
-    df_html = df_html.drop(columns=['smiles-res'], axis=1)
-    if len(df_html) > 500:
-        df_html = df_html.head(500)
-    return df_html
-
-
-def clean_lists_columns(alert_value):
-    """Clean the columns that are lists."""
-    if alert_value == "['-']":
-        return 0
-    try:
-        return len(literal_eval(alert_value))
-    except (SyntaxError, ValueError):
-        return 0
-
-
-def clean_medicinal_columns(med_value, rules=True):
-    if rules:
-        if med_value == 0:
-            return 'Accepted'
+from .admet_schema import read_compact, RULE_COLUMNS, SYNTHESIS_COLUMNS
+
+SCORE_COLUMNS = ['Pharmisa Score', 'toxicity_score', 'medicinal_score', 'absortion_score', 'distribution_score',
+                 'metabolism_score', 'excretion_score', 'tox21_score']
+THRESHOLDS = {
+    'QED': (0.67, 0.67),
+    'Fsp3': (0.42, 0.42),
+    'MCE-18': (45, 45),
+    'SA-score': (6, 6),
+    'caco2': (-5.15, -5.15),
+    'cl-plasma': (5, 15),
+    't0.5': (1, 8),
+}
+MAX_ROWS = 500
+REPORT_TEMPLATE = 'report_template.html'
+ROWS_PER_WRITE = 1000
+# Cell colors of the report, as indexes of CELL_TAGS. The closing </td> is optional and left out to keep big
+# reports small
+NO_COLOR, GOOD, MEDIUM, BAD = 0, 1, 2, 3
+CELL_TAGS = np.array(['<td>', '<td class=g>', '<td class=y>', '<td class=r>'], dtype=object)
+WHOLE_TEXTS = np.array([str(whole) for whole in range(10000)], dtype=object)
+DECIMAL_TEXTS = np.array([f'.{thousandths:03d}' for thousandths in range(1000)], dtype=object)
+REPORT_HEAD = """<head>
+    <link rel='preconnect' href='https://fonts.googleapis.com'>
+    <link rel='preconnect' href='https://fonts.gstatic.com' crossorigin>
+    <link href='https://fonts.googleapis.com/css2?family=Lato:wght@400;700&display=swap' rel='stylesheet'>
+    <style>
+        body {
+            font-family: 'Lato', sans-serif;
+        }
+        td.g {
+            background-color: #58D68D;
+        }
+        td.y {
+            background-color: #F4D03F;
+        }
+        td.r {
+            background-color: #EC7063;
+        }
+    </style>
+</head>
+"""
+
+
+def normalize(values, lower_threshold, upper_threshold, is_reverse=False):
+    """Piecewise normalization of an array of values: below the lower threshold, above the upper threshold and
+    in between"""
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if is_reverse:
+            below = 0.7 + 0.3 * (values / lower_threshold)
+            above = 0.3 * (values / lower_threshold)
         else:
-            return 'Rejected'
-    else:
-        if med_value == 0:
-            return 'Easy'
+            below = 0.3 * (values / lower_threshold)
+            above = 0.7 + 0.3 * ((values - upper_threshold) / (1 - upper_threshold))
+        between = 0.3 + 0.4 * ((values - lower_threshold) / (upper_threshold - lower_threshold))
+    return np.select([values <= lower_threshold, values >= upper_threshold], [below, above], between)
+
+
+def score_where(condition, good_score=0.15, bad_score=0.85):
+    """good_score where the condition holds, bad_score elsewhere"""
+    return np.where(condition, good_score, bad_score)
+
+
+def to_scoring_types(df: pd.DataFrame):
+    """The scores are computed in float64, with the rules as strings and the alert counts as int64"""
+    for column in df.columns:
+        if df[column].dtype == 'float32':
+            df[column] = df[column].astype('float64')
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+        elif df[column].dtype == 'uint8':
+            df[column] = df[column].astype('int64')
+    return df
+
+
+def to_script_string(text: str):
+    """JavaScript string literal of a text, safe inside a <script> element"""
+    return json.dumps(text).replace('<', '\\u003c')
+
+
+def format_numbers(numbers: np.ndarray):
+    """Same text as '{:.3f}'.format(x) for each number rounded by numpy, built from the texts of the whole and
+    decimal parts"""
+    rounded = numbers.round(3)
+    regular = np.abs(rounded) < 1e12
+    thousandths = np.abs(np.rint(np.where(regular, rounded, 0) * 1000)).astype(np.int64)
+    wholes = thousandths // 1000
+    small = wholes < len(WHOLE_TEXTS)
+    texts = WHOLE_TEXTS[np.where(small, wholes, 0)]
+    if not small.all():
+        texts[~small] = wholes[~small].astype(str)
+    texts = texts + DECIMAL_TEXTS[thousandths % 1000]
+    texts = np.where(np.signbit(rounded), '-' + texts, texts)
+    if not regular.all():
+        texts[~regular] = ['{:.3f}'.format(number) for number in rounded[~regular]]
+    return texts
+
+
+class Scorer:
+    """Pharmisa Score and its components for the results table of one run.
+    Holds only its configuration, so the same Scorer can score several tables at once from different threads"""
+    def __init__(self, groups: dict, thresholds: dict = None):
+        self.groups = groups
+        self.thresholds = dict(thresholds or THRESHOLDS)
+        self.toxicity_columns = [column for column in groups['toxicity']
+                                 if column not in ['IGC50', 'LC50DM', 'LC50FM', 'BCF', 'EC']]
+
+    def score(self, results_df: pd.DataFrame):
+        """Copy of the results table with the scores, sorted by Pharmisa Score, the scores first and the SMILES
+        last"""
+        scored_df = results_df.copy()
+        scored_df = self.get_toxicity_score(scored_df)
+        scored_df = self.get_medicinal_score(scored_df)
+        scored_df = self.get_absortion_score(scored_df)
+        scored_df = self.get_distribution_score(scored_df)
+        scored_df = self.get_metabolism_score(scored_df)
+        scored_df = self.get_excretion_score(scored_df)
+        scored_df = self.get_tox21_score(scored_df)
+        scored_df = self.get_pharmisa_score(scored_df)
+        scored_df = scored_df.sort_values(by='Pharmisa Score', ascending=True)
+        scored_df = scored_df.reset_index(drop=True)
+        first_columns = ['Molecule ID'] + SCORE_COLUMNS
+        rest_of_columns = [col for col in scored_df.columns if col not in first_columns and col != 'SMILES']
+        return scored_df[first_columns + rest_of_columns + ['SMILES']]
+
+    def get_toxicity_score(self, input_df):
+        toxicity_region_dropped = input_df[self.toxicity_columns]
+        input_df['mean_toxicity'] = toxicity_region_dropped.mean(axis=1)
+        input_df['std_toxicity'] = toxicity_region_dropped.std(axis=1)
+        # Count the number of high toxicity values
+        high_toxicity_count = (toxicity_region_dropped > 0.7).sum(axis=1)
+
+        penalty = 0.1 * high_toxicity_count
+        input_df['toxicity_score'] = (input_df['mean_toxicity'] + input_df['std_toxicity']) / 2 + penalty
+        input_df['toxicity_score'] = np.clip(input_df['toxicity_score'], 0, 1)
+        input_df = input_df.drop(columns=['mean_toxicity', 'std_toxicity'], axis=1)
+        return input_df
+
+    def get_medicinal_score(self, input_df):
+        thresholds = self.thresholds
+        input_df['qed_score'] = normalize(input_df['QED'], thresholds['QED'][0], thresholds['QED'][1],
+                                          is_reverse=True)
+        input_df['gasa_score'] = score_where(input_df['gasa'] == 'Easy')
+        input_df['sascore_score'] = normalize(input_df['QED'], thresholds['QED'][0], thresholds['QED'][1])
+        input_df['fsp3_score'] = normalize(input_df['Fsp3'], thresholds['Fsp3'][0], thresholds['Fsp3'][1],
+                                           is_reverse=True)
+        input_df['mce18_score'] = normalize(input_df['MCE-18'], thresholds['MCE-18'][0], thresholds['MCE-18'][1],
+                                            is_reverse=True)
+        input_df['alarmnmr_score'] = score_where(input_df['Alarm_NMR'] == "['-']")
+        input_df['bms_score'] = score_where(input_df['BMS'] == "['-']")
+        input_df['pains_score'] = score_where(input_df['PAINS'] == "['-']")
+        input_df['chelating_score'] = score_where(input_df['Chelating'] == "['-']")
+        input_df['pfizer_score'] = score_where(input_df['Pfizer'] == 'Accepted')
+        input_df['lipinski_score'] = score_where(input_df['Lipinski'] == 'Accepted')
+        input_df['gsk_score'] = score_where(input_df['GSK'] == 'Accepted', bad_score=0.85 * 2)
+        input_df['goldentriangle_score'] = score_where(input_df['GoldenTriangle'] == 'Accepted',
+                                                       bad_score=0.85 * 2)
+        new_score_columns = ['qed_score', 'gasa_score', 'sascore_score', 'fsp3_score', 'mce18_score',
+                             'alarmnmr_score', 'bms_score', 'pains_score', 'chelating_score', 'pfizer_score',
+                             'lipinski_score', 'gsk_score', 'goldentriangle_score']
+        for column in self.groups['assay']:
+            input_df[column] = input_df[column].astype(float)
+        weights = {
+            'pfizer_score': 20,
+            'sascore_score': 20,
+            'lipinski_score': 10,
+            'gsk_score': 5,
+            'goldentriangle_score': 3,
+            'qed_score': 1,
+            'gasa_score': 1,
+            'fsp3_score': 1,
+            'mce18_score': 1,
+            'alarmnmr_score': 1,
+            'bms_score': 1,
+            'pains_score': 1,
+            'chelating_score': 1
+
+        }
+
+        for score, weight in weights.items():
+            input_df[score + '_weighted'] = input_df[score] * weight
+
+        weights_sum = sum(weights.values())
+        input_df['medicinal_score'] = (input_df[[score + '_weighted' for score in weights.keys()]].sum(axis=1) /
+                                       weights_sum)
+        input_df = input_df.drop(columns=[score + '_weighted' for score in weights.keys()], axis=1)
+        input_df.drop(columns=new_score_columns, axis=1, inplace=True)
+
+        return input_df
+
+    def get_absortion_score(self, input_df):
+        absortion = self.groups['absorption']
+        input_df['caco2_score'] = normalize(input_df['caco2'], self.thresholds['caco2'][0],
+                                            self.thresholds['caco2'][1], is_reverse=True)
+        absortion_score = pd.concat([input_df[absortion], input_df['caco2_score']], axis=1)
+        absortion_score = absortion_score.drop(columns=['caco2', 'MDCK'], axis=1)
+        input_df['absortion_score'] = absortion_score.mean(axis=1)
+        input_df = input_df.drop(columns=['caco2_score'], axis=1)
+        return input_df
+
+    def get_distribution_score(self, input_df):
+        distribution = self.groups['distribution']
+        input_df['logvdss_score'] = score_where((input_df['logVDss'] > 0.04) & (input_df['logVDss'] < 20))
+        input_df['ppb_score'] = score_where(input_df['PPB'] <= 90.0)
+        input_df['fu_score'] = score_where(input_df['Fu'] > 5.0)
+        distribution_score = pd.concat([input_df[distribution],
+                                        input_df[['logvdss_score', 'ppb_score', 'fu_score']]], axis=1)
+        distribution_score = distribution_score.drop(columns=['logVDss', 'PPB', 'Fu'], axis=1)
+        input_df['distribution_score'] = distribution_score.mean(axis=1)
+        input_df = input_df.drop(columns=['logvdss_score', 'ppb_score', 'fu_score'], axis=1)
+        return input_df
+
+    def get_metabolism_score(self, input_df):
+        metabolism = self.groups['metabolism']
+        input_df['lmhuman_score'] = 1 - input_df['LM-human']
+        metabolism_score = pd.concat([input_df[metabolism], input_df['lmhuman_score']], axis=1)
+        metabolism_score = metabolism_score.drop(columns=['LM-human'], axis=1)
+        input_df['metabolism_score'] = metabolism_score.mean(axis=1)
+        input_df = input_df.drop(columns=['lmhuman_score'], axis=1)
+        return input_df
+
+    def get_excretion_score(self, input_df):
+        input_df['clplasma_score'] = normalize(input_df['cl-plasma'], self.thresholds['cl-plasma'][0],
+                                               self.thresholds['cl-plasma'][1])
+        input_df['t0.5_score'] = normalize(input_df['t0.5'], self.thresholds['t0.5'][0], self.thresholds['t0.5'][1],
+                                           is_reverse=True)
+        excretion_score = input_df[['clplasma_score', 't0.5_score']]
+        input_df['excretion_score'] = excretion_score.mean(axis=1)
+        input_df = input_df.drop(columns=['clplasma_score', 't0.5_score'], axis=1)
+        return input_df
+
+    def get_tox21_score(self, input_df):
+        tox21_score = input_df[self.groups['tox21']]
+        input_df['tox21_score'] = tox21_score.mean(axis=1)
+        return input_df
+
+    @staticmethod
+    def get_pharmisa_score(input_df):
+        weights = {
+            'toxicity_score': 20,
+            'medicinal_score': 15,
+            'absortion_score': 3,
+            'distribution_score': 2.5,
+            'metabolism_score': 2,
+            'excretion_score': 1,
+            'tox21_score': 1
+        }
+
+        for score, weight in weights.items():
+            input_df[score + '_weighted'] = input_df[score] * weight
+
+        weights_sum = sum(weights.values())  # A soma dos pesos
+        input_df['Pharmisa Score'] = (input_df[[score + '_weighted' for score in weights.keys()]].sum(axis=1) /
+                                      weights_sum)
+        input_df = input_df.drop(columns=[score + '_weighted' for score in weights.keys()], axis=1)
+        return input_df
+
+
+class ReportBuilder:
+    """Builds the html report of one run from its compact results table: a page that loads the table from a data
+    file next to it, or a plain html table if static"""
+    def __init__(self, output_folder_path: str, folder_name: str, max_rows: int = None, static: bool = False):
+        self.output_folder_path = output_folder_path
+        self.folder_name = folder_name
+        self.max_rows = max_rows
+        self.static = static
+        self.results_df, groups = read_compact(f"{output_folder_path}/results/admet_filtered.parquet")
+        self.results_df = to_scoring_types(self.results_df)
+        self.scorer = Scorer(groups)
+        self.no_color_columns = ['Molecule ID', 'SMILES', 'Score Pharmit', 'RMSD Pharmit', 'Alarm_NMR', 'BMS',
+                                 'Chelating', 'PAINS', 'Natural Product-likeness', 't0.5', 'CYP1A2-inh', 'CYP1A2-sub',
+                                 'CYP2C19-inh', 'CYP2C19-sub', 'CYP2C9-inh', 'CYP2C9-sub', 'CYP2D6-inh', 'CYP2D6-sub',
+                                 'CYP3A4-inh', 'CYP3A4-sub', 'CYP2B6-inh', 'CYP2B6-sub', 'CYP2C8-inh', 'IGC50',
+                                 'LC50DM', 'LC50FM', 'BCF', 'NonBiodegradable', 'NonGenotoxic_Carcinogenicity',
+                                 'SureChEMBL', 'Skin_Sensitization', 'Acute_Aquatic_Toxicity', 'Toxicophores',
+                                 'Genotoxic_Carcinogenicity_Mutagenicity']
+        self.strange_columns = ['QED', 'Fsp3', 'MCE-18', 'SA-score', 'caco2', 'cl-plasma']
+        self.normal_values_columns = list(groups['assay'])
+        self.normal_values_columns.extend(column for column in groups['absorption']
+                                          if column not in self.strange_columns)
+        self.normal_values_columns.extend(groups['toxicity'][4:])
+        self.normal_values_columns.extend(groups['tox21'])
+        self.normal_values_columns.extend(SCORE_COLUMNS)
+        self.normal_values_columns.remove('MDCK')
+        self.medicinal_rules_columns = RULE_COLUMNS + SYNTHESIS_COLUMNS
+
+    def color_codes(self, column_name: str, values: pd.Series):
+        """Color of each cell of a column as an index of CELL_TAGS, from the values shown in the report (3 decimals)"""
+        no_color = np.zeros(len(values), dtype=np.int8)
+        if column_name in self.no_color_columns:
+            return no_color
+        elif column_name in self.medicinal_rules_columns:
+            return np.where(values.isin(['Accepted', 'Easy']), GOOD, BAD).astype(np.int8)
+        numbers = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float).round(3)
+        if column_name in self.normal_values_columns:
+            return np.select([(numbers >= 0) & (numbers <= 0.3), (numbers > 0.3) & (numbers <= 0.7)], [GOOD, MEDIUM],
+                             BAD).astype(np.int8)
+        elif column_name == 'QED':
+            good = numbers > 0.67
+        elif column_name == 'Fsp3':
+            good = numbers >= 0.42
+        elif column_name == 'MCE-18':
+            good = numbers >= 45
+        elif column_name == 'SA-score':
+            good = numbers <= 6
+        elif column_name == 'caco2':
+            good = numbers > -5.15
+        elif column_name == 'cl-plasma':
+            return np.select([(numbers > 0) & (numbers <= 5), (numbers > 5) & (numbers <= 15)], [GOOD, MEDIUM],
+                             BAD).astype(np.int8)
         else:
-            return 'Hard'
-
-
-def normalize(value, lower_threshold, upper_threshold, is_reverse=False):
-    if value <= lower_threshold:
-        if is_reverse:
-            return 0.7 + 0.3 * (value / lower_threshold)
-        return 0.3 * (value / lower_threshold)
-    elif value >= upper_threshold:
-        if is_reverse:
-            return 0.3 * (value / lower_threshold)
-        return 0.7 + 0.3 * ((value - upper_threshold) / (1 - upper_threshold))
-    else:
-        return 0.3 + 0.4 * ((value - lower_threshold) / (upper_threshold - lower_threshold))
-
-
-def get_toxicity_score(input_df):
-    toxicity = input_df.columns[62:86]
-    toxicity_region_dropped = input_df[toxicity].drop(columns=['IGC50', 'LC50DM', 'LC50FM', 'BCF', 'EC'], axis=1)
-    input_df['mean_toxicity'] = toxicity_region_dropped.mean(axis=1)
-    input_df['std_toxicity'] = toxicity_region_dropped.std(axis=1)
-    # Count the number of high toxicity values
-    high_toxicity_count = (toxicity_region_dropped > 0.7).sum(axis=1)
-
-    penalty = 0.1 * high_toxicity_count
-    input_df['toxicity_score'] = (input_df['mean_toxicity'] + input_df['std_toxicity']) / 2 + penalty
-    input_df['toxicity_score'] = np.clip(input_df['toxicity_score'], 0, 1)
-    input_df = input_df.drop(columns=['mean_toxicity', 'std_toxicity'], axis=1)
-    return input_df
-
-
-def get_medicinal_score(input_df):
-    global thresholds
-    input_df['qed_score'] = input_df['QED'].apply(lambda x: normalize(x, thresholds['QED'][0], thresholds['QED'][1],
-                                                                      is_reverse=True))
-    input_df['gasa_score'] = input_df['gasa'].apply(lambda x: 0.15 if x == 'Easy' else 0.85)
-    input_df['sascore_score'] = input_df['QED'].apply(lambda x: normalize(x, thresholds['QED'][0],
-                                                                          thresholds['QED'][1]))
-    input_df['fsp3_score'] = input_df['Fsp3'].apply(lambda x: normalize(x, thresholds['Fsp3'][0],
-                                                                        thresholds['Fsp3'][1], is_reverse=True))
-    input_df['mce18_score'] = input_df['MCE-18'].apply(lambda x: normalize(x, thresholds['MCE-18'][0],
-                                                                           thresholds['MCE-18'][1], is_reverse=True))
-    input_df['alarmnmr_score'] = input_df['Alarm_NMR'].apply(lambda x: 0.15 if x == "['-']" else 0.85)
-    input_df['bms_score'] = input_df['BMS'].apply(lambda x: 0.15 if x == "['-']" else 0.85)
-    input_df['pains_score'] = input_df['PAINS'].apply(lambda x: 0.15 if x == "['-']" else 0.85)
-    input_df['chelating_score'] = input_df['Chelating'].apply(lambda x: 0.15 if x == "['-']" else 0.85)
-    input_df['pfizer_score'] = input_df['Pfizer'].apply(lambda x: 0.15 if x == 'Accepted' else 0.85)
-    input_df['lipinski_score'] = input_df['Lipinski'].apply(lambda x: 0.15 if x == 'Accepted' else 0.85)
-    input_df['gsk_score'] = input_df['GSK'].apply(lambda x: 0.15 if x == 'Accepted' else 0.85 * 2)
-    input_df['goldentriangle_score'] = input_df['GoldenTriangle'].apply(lambda x: 0.15 if x == 'Accepted' else 0.85 * 2)
-    new_score_columns = ['qed_score', 'gasa_score', 'sascore_score', 'fsp3_score', 'mce18_score', 'alarmnmr_score',
-                         'bms_score', 'pains_score', 'chelating_score', 'pfizer_score', 'lipinski_score', 'gsk_score',
-                         'goldentriangle_score']
-    columns_to_change = ['Aggregators', 'Fluc', 'Blue_fluorescence', 'Green_fluorescence', 'Reactive', 'Promiscuous']
-    for column in columns_to_change:
-        input_df[column] = input_df[column].astype(float)
-    weights = {
-        'pfizer_score': 20,
-        'sascore_score': 20,
-        'lipinski_score': 10,
-        'gsk_score': 5,
-        'goldentriangle_score': 3,
-        'qed_score': 1,
-        'gasa_score': 1,
-        'fsp3_score': 1,
-        'mce18_score': 1,
-        'alarmnmr_score': 1,
-        'bms_score': 1,
-        'pains_score': 1,
-        'chelating_score': 1
-
-    }
-
-    for score, weight in weights.items():
-        input_df[score + '_weighted'] = input_df[score] * weight
-
-    weights_sum = sum(weights.values())
-    input_df['medicinal_score'] = input_df[[score + '_weighted' for score in weights.keys()]].sum(axis=1) / weights_sum
-    input_df = input_df.drop(columns=[score + '_weighted' for score in weights.keys()], axis=1)
-    input_df.drop(columns=new_score_columns, axis=1, inplace=True)
-
-    return input_df
-
-
-def get_absortion_score(input_df):
-    global thresholds
-    absortion = input_df.columns[21:30]
-    input_df['caco2_score'] = input_df['caco2'].apply(lambda x: normalize(x, thresholds['caco2'][0],
-                                                                          thresholds['caco2'][1], is_reverse=True))
-    absortion_score = pd.concat([input_df[absortion], input_df['caco2_score']], axis=1)
-    absortion_score = absortion_score.drop(columns=['caco2', 'MDCK'], axis=1)
-    input_df['absortion_score'] = absortion_score.mean(axis=1)
-    input_df = input_df.drop(columns=['caco2_score'], axis=1)
-    return input_df
-
-
-def get_distribution_score(input_df):
-    distribution = input_df.columns[30:39]
-    input_df['logvdss_score'] = input_df['logVDss'].apply(lambda x: 0.15 if 0.04 < x < 20 else 0.85)
-    input_df['ppb_score'] = input_df['PPB'].apply(lambda x: 0.15 if x <= 90.0 else 0.85)
-    input_df['fu_score'] = input_df['Fu'].apply(lambda x: 0.15 if x > 5.0 else 0.85)
-    distribution_score = pd.concat([input_df[distribution], input_df[['logvdss_score', 'ppb_score', 'fu_score']]],
-                                   axis=1)
-    distribution_score = distribution_score.drop(columns=['logVDss', 'PPB', 'Fu'], axis=1)
-    input_df['distribution_score'] = distribution_score.mean(axis=1)
-    input_df = input_df.drop(columns=['logvdss_score', 'ppb_score', 'fu_score'], axis=1)
-    return input_df
-
-
-def get_metabolism_score(input_df):
-    metabolism = input_df.columns[39:53]
-    input_df['lmhuman_score'] = input_df['LM-human'].apply(lambda x: 1 - x)
-    metabolism_score = pd.concat([input_df[metabolism], input_df['lmhuman_score']], axis=1)
-    metabolism_score = metabolism_score.drop(columns=['LM-human'], axis=1)
-    input_df['metabolism_score'] = metabolism_score.mean(axis=1)
-    input_df = input_df.drop(columns=['lmhuman_score'], axis=1)
-    return input_df
-
-
-def get_excretion_score(input_df):
-    global thresholds
-    input_df['clplasma_score'] = input_df['cl-plasma'].apply(lambda x: normalize(x, thresholds['cl-plasma'][0],
-                                                                                 thresholds['cl-plasma'][1]))
-    input_df['t0.5_score'] = input_df['t0.5'].apply(lambda x: normalize(x, thresholds['t0.5'][0], thresholds['t0.5'][1],
-                                                                        is_reverse=True))
-    excretion_score = input_df[['clplasma_score', 't0.5_score']]
-    input_df['excretion_score'] = excretion_score.mean(axis=1)
-    input_df = input_df.drop(columns=['clplasma_score', 't0.5_score'], axis=1)
-    return input_df
-
-
-def get_tox21_score(input_df):
-    tox21 = input_df.columns[86:98]
-    tox21_score = input_df[tox21]
-    input_df['tox21_score'] = tox21_score.mean(axis=1)
-    return input_df
-
-
-def get_pharmisa_score(input_df):
-    weights = {
-        'toxicity_score': 20,
-        'medicinal_score': 15,
-        'absortion_score': 3,
-        'distribution_score': 2.5,
-        'metabolism_score': 2,
-        'excretion_score': 1,
-        'tox21_score': 1
-    }
-
-    for score, weight in weights.items():
-        input_df[score + '_weighted'] = input_df[score] * weight
-
-    weights_sum = sum(weights.values())  # A soma dos pesos
-    input_df['Pharmisa Score'] = input_df[[score + '_weighted' for score in weights.keys()]].sum(axis=1) / weights_sum
-    input_df = input_df.drop(columns=[score + '_weighted' for score in weights.keys()], axis=1)
-    return input_df
-
-
-def results_to_html(output_folder_path: str, folder_name: str):
-    """Converts the results to a html file"""
-    global df_old
-    df_old = pd.read_csv(f"{output_folder_path}/results/admet_filtered.csv")
-    define_globals(df_old)
-    subtitle = None
-    if len(df_old) > 500:
-        subtitle = f"<h4>The results shown are limited to 500. Total results: {len(df_old)}.</h4>"
-    df_html = get_df_html(df_old)
-    df_html = df_html.round(3)
-    for col in df_html.columns:
-        df_html[col] = df_html[col].apply(lambda x: '{:.3f}'.format(x) if isinstance(x, (int, float)) else x)
-    styled_html_df = df_html.style.apply(color_format, axis=0)
-    html = styled_html_df.to_html(index=False)
-    html = """
-    <head>
-        <link rel='preconnect' href='https://fonts.googleapis.com'>
-        <link rel='preconnect' href='https://fonts.gstatic.com' crossorigin>
-        <link href='https://fonts.googleapis.com/css2?family=Lato:wght@400;700&display=swap' rel='stylesheet'>
-        <style>
-            body {
-                font-family: 'Lato', sans-serif;
-            }
-        </style>
-    </head>
-    """ + html
-    if subtitle:
-        html = subtitle + html
-    with open(f"{output_folder_path}/results/{folder_name}_results.html", "w") as f:
-        f.write(html)
+            return no_color
+        return np.where(good, GOOD, BAD).astype(np.int8)
+
+    @staticmethod
+    def format_column(values: pd.Series):
+        """Text of each cell of a column: numbers with 3 decimals, the rest escaped"""
+        if values.dtype.kind in 'fiu':
+            return format_numbers(values.to_numpy(dtype=float))
+        texts = values.astype(str)
+        to_escape = texts.str.contains('[&<>"\']', regex=True).to_numpy()
+        if to_escape.any():
+            texts[to_escape] = texts[to_escape].map(html.escape)
+        return texts.to_numpy(dtype=object)
+
+    def write_table(self, df_html: pd.DataFrame, f):
+        """Writes the table to an open file, ROWS_PER_WRITE rows at a time"""
+        f.write('<table>\n<thead>\n<tr><th></th>')
+        f.write(''.join(f'<th>{html.escape(str(column))}</th>' for column in df_html.columns))
+        f.write('</tr>\n</thead>\n<tbody>\n')
+        cell_columns = [(CELL_TAGS[self.color_codes(column, df_html[column])] +
+                         self.format_column(df_html[column])).tolist() for column in df_html.columns]
+        for start in range(0, len(df_html), ROWS_PER_WRITE):
+            rows = zip(*(cells[start:start + ROWS_PER_WRITE] for cells in cell_columns))
+            f.write(''.join(f'<tr><th>{start + i}</th>{"".join(row)}</tr>\n' for i, row in enumerate(rows)))
+        f.write('</tbody>\n</table>\n')
+
+    def write_data(self, df_html: pd.DataFrame, f):
+        """Writes the table as a script with one array per column, that hands it to the report shell"""
+        numeric = [df_html[column].dtype.kind in 'fiu' for column in df_html.columns]
+        colors = []
+        for column in df_html.columns:
+            codes = self.color_codes(column, df_html[column])
+            colors.append((codes + ord('0')).astype(np.uint8).tobytes().decode() if codes.any() else None)
+        f.write(f'pharmisaReport({{"rows": {len(df_html)}, "columns": {json.dumps(list(df_html.columns))}, '
+                f'"numeric": {json.dumps(numeric)}, "colors": {json.dumps(colors)}, "values": [\n')
+        for i, column in enumerate(df_html.columns):
+            if numeric[i]:
+                numbers = df_html[column].to_numpy(dtype=float)
+                texts = np.where(np.isfinite(numbers), format_numbers(numbers), 'null')
+                f.write(f"[{','.join(texts)}]")
+            else:
+                f.write(json.dumps(df_html[column].astype(str).tolist()))
+            f.write(',\n' if i < len(df_html.columns) - 1 else '\n')
+        f.write(']});\n')
+
+    def write_report(self, df_html: pd.DataFrame):
+        """Writes the report shell and the data file it loads, returns the path of the shell"""
+        html_path = f"{self.output_folder_path}/results/{self.folder_name}_results.html"
+        data_file_name = f"{self.folder_name}_results_data.js"
+        with open(f"{self.output_folder_path}/results/{data_file_name}", "w") as f:
+            self.write_data(df_html, f)
+        template = files('pharmisa').joinpath(REPORT_TEMPLATE).read_text()
+        with open(html_path, "w") as f:
+            f.write(template.replace('{{TITLE}}', html.escape(f"{self.folder_name} results"))
+                    .replace('{{DATA_FILE}}', to_script_string(data_file_name)))
+        return html_path
+
+    def write_static_report(self, df_html: pd.DataFrame):
+        """Writes the report as a plain html table, returns its path"""
+        html_path = f"{self.output_folder_path}/results/{self.folder_name}_results.html"
+        with open(html_path, "w") as f:
+            if len(df_html) < len(self.results_df):
+                f.write(f"<h4>The results shown are limited to {self.max_rows}. "
+                        f"Total results: {len(self.results_df)}.</h4>\n")
+            f.write(REPORT_HEAD)
+            self.write_table(df_html, f)
+        return html_path
+
+    def build(self):
+        """Scores the results and writes the report, returns its path"""
+        df_html = self.scorer.score(self.results_df)
+        if self.max_rows is not None:
+            df_html = df_html.head(self.max_rows)
+        if self.static:
+            return self.write_static_report(df_html)
+        return self.write_report(df_html)
+
+
+def results_to_html(output_folder_path: str, folder_name: str, max_rows: int = None, static: bool = False):
+    """Converts the results to a html file, with the max_rows best molecules (all of them if None).
+    The report is paginated, sortable and filterable in the browser, or a plain html table if static"""
+    return ReportBuilder(output_folder_path, folder_name, max_rows, static).build()
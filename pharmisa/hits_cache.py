@@ -0,0 +1,109 @@
+import json
+import os
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CACHE_FILE_NAME = 'pharmit_hits.parquet'
+CACHE_METADATA_KEY = b'pharmisa_sources'
+HITS_COLUMNS = ['mol_ids', 'score', 'rmsd', 'database', 'file', 'offset', 'smiles', 'canonical', 'inchikey']
+KEY_COLUMNS = ['smiles', 'canonical', 'inchikey']
+HITS_SCHEMA = pa.schema([('mol_ids', pa.string()), ('score', pa.float64()), ('rmsd', pa.float64()),
+                         ('database', pa.string()), ('file', pa.string()), ('offset', pa.int64()),
+                         ('smiles', pa.string()), ('canonical', pa.string()), ('inchikey', pa.string())])
+DATABASE_PREFIXES = [
+    (re.compile(r'CHEMBL\d'), 'chembl'),
+    (re.compile(r'MCULE-'), 'mcule'),
+    (re.compile(r'MolPort-'), 'molport'),
+    (re.compile(r'ZINC'), 'zinc'),
+    (re.compile(r'CS[A-Z]{0,2}\d'), 'chemspace'),
+    (re.compile(r'\d+$'), 'pubchem'),
+]
+
+
+def guess_database(mol_ids: str):
+    """Database of a hit inferred from the prefix of its first id, 'other' if unknown"""
+    first_id = mol_ids.split(' ', 1)[0]
+    for pattern, database in DATABASE_PREFIXES:
+        if pattern.match(first_id):
+            return database
+    return 'other'
+
+
+def get_cache_path(output_folder_path: str):
+    return os.path.join(output_folder_path, CACHE_FILE_NAME)
+
+
+def get_sources_signature(sdf_files: list):
+    """Name, size and modification time of the sdf files, in the order they are processed"""
+    signature = []
+    for file in sdf_files:
+        stat = os.stat(file)
+        signature.append([os.path.basename(file), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def new_hits_columns():
+    return {column: [] for column in HITS_COLUMNS}
+
+
+def hits_columns_to_df(columns: dict):
+    df = pd.DataFrame(columns, columns=HITS_COLUMNS)
+    df['score'] = df['score'].astype('float64')
+    df['rmsd'] = df['rmsd'].astype('float64')
+    df['offset'] = df['offset'].astype('int64')
+    for column in KEY_COLUMNS:
+        df[column] = df[column].astype('object')
+    return df
+
+
+def open_hits_cache(output_folder_path: str, sdf_files: list):
+    """Open the cached hits table. Returns None if there is no cache or if any sdf file changed since it was written"""
+    cache_path = get_cache_path(output_folder_path)
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        parquet_file = pq.ParquetFile(cache_path)
+    except (OSError, pa.ArrowInvalid):
+        return None
+    metadata = parquet_file.schema_arrow.metadata or {}
+    sources = metadata.get(CACHE_METADATA_KEY)
+    if sources is None or json.loads(sources) != get_sources_signature(sdf_files):
+        parquet_file.close()
+        return None
+    return parquet_file
+
+
+def iter_hits_cache(parquet_file: pq.ParquetFile, start: int = 0, stop: int = None):
+    """Yield the cached hits table one row group (one shard of the run that wrote it) at a time"""
+    stop = parquet_file.num_row_groups if stop is None else stop
+    for index in range(start, stop):
+        yield hits_columns_to_df(parquet_file.read_row_group(index).to_pydict())
+
+
+class HitsCacheWriter:
+    """Writes the hits table to the cache one shard at a time, as a row group each, so the whole table is
+    never in memory. The new cache replaces the old one when closed"""
+    def __init__(self, output_folder_path: str, sdf_files: list):
+        self.cache_path = get_cache_path(output_folder_path)
+        metadata = {CACHE_METADATA_KEY: json.dumps(get_sources_signature(sdf_files)).encode()}
+        self.writer = pq.ParquetWriter(f"{self.cache_path}.tmp", HITS_SCHEMA.with_metadata(metadata))
+
+    def write(self, hits_df: pd.DataFrame):
+        if len(hits_df):
+            self.writer.write_table(pa.Table.from_pandas(hits_df, schema=self.writer.schema, preserve_index=False))
+
+    def close(self):
+        self.writer.close()
+        os.replace(f"{self.cache_path}.tmp", self.cache_path)
+
+    def abort(self):
+        """Drop the partial table, keeping the old cache"""
+        self.writer.close()
+        os.remove(f"{self.cache_path}.tmp")
+
+
+def filter_hits(hits_df: pd.DataFrame, score: float, cli_rmsd: float):
+    """Rows that fit the threshold (score < input_score and rmsd <= input_rmsd), in file order"""
+    return hits_df[(hits_df['score'].values < score) & (hits_df['rmsd'].values <= cli_rmsd)]
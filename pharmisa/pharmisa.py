@@ -17,12 +17,17 @@ from pharmisa.top_feature_configs import run_feature_configs
 from pharmisa.pharma_optimizer import PharmaOptimizer
 from pharmisa.json_handler import JsonHandler
 from pharmisa.sdf_processor import SdfProcessor
-from pharmisa.fpadmet import run_fpadmet
-from pharmisa.admet_request import run_admet_request
+from pharmisa.sdf_pipeline import SdfPipeline
+from pharmisa.dedup_index import DEDUP_KEYS
+from pharmisa.threshold_sweep import get_sweep_grid
+from pharmisa.fpadmet import run_fpadmet, check_fpadmet_models, FPADMET_WORKERS
+from pharmisa.admet_request import run_admet_request, warm_admet_cache, ADMET_CONCURRENCY
+from pharmisa.admet_cache import AdmetCache
+from pharmisa.admet_journal import get_journal_path
 from pharmisa.admet_analyzer import AdmetAnalyzer
-from pharmisa.get_html import results_to_html
+from pharmisa.get_html import results_to_html, MAX_ROWS
 from pharmisa.utils import *
-from pharmisa.exceptions import AdmetServerError, NoMoleculeError
+from pharmisa.exceptions import AdmetServerError, NoMoleculeError, AdmetSchemaError, FpadmetError
 
 
 @click.command()
@@ -56,12 +61,47 @@ from pharmisa.exceptions import AdmetServerError, NoMoleculeError
 @click.option("--pharmisa_params", is_flag=True,
               help="Activate Pharmisa default parameters for the pharmacophore search")
 @click.option("-f", "--fpadmet", is_flag=True, help="Activate FPADMET toxicity filter before the admet analysis")
+@click.option("--fpadmet_workers", type=click.IntRange(min=1), default=FPADMET_WORKERS,
+              help="Number of FPADMET endpoints predicted at the same time")
+@click.option("--fpadmet_chunk_size", type=click.IntRange(min=1), default=None,
+              help="Run FPADMET in shards of N molecules, keeping only the best molecules in memory")
 @click.option("--firefox", is_flag=True, help="Use Firefox as the browser for the pharmit search")
+@click.option("--stream", is_flag=True,
+              help="Parse the minimized_results .sdf.gz files directly, keeping them compressed on disk")
+@click.option("--workers", type=click.IntRange(min=1), default=1,
+              help="Number of processes used to parse the .sdf files")
+@click.option("--dedup", type=click.Choice(DEDUP_KEYS), default='smiles',
+              help="Key used to remove duplicated molecules: SMILES, canonical isomeric SMILES or InChIKey")
+@click.option("--top-k", "top_k", type=click.IntRange(min=1), default=None,
+              help="Keep only the N molecules with the best score (RMSD as tie-breaker) after the filtering")
+@click.option("--no_cache", is_flag=True,
+              help="Don't read or write the parquet cache of the parsed pharmit hits in the run folder")
+@click.option("--sweep", is_flag=True,
+              help="Only count the unique molecules over a grid of score and RMSD thresholds, without the ADMET "
+                   "analysis")
+@click.option("--pipeline", is_flag=True,
+              help="Parse each pharmit download in the background while the other databases are still searching")
+@click.option("--admet_concurrency", type=click.IntRange(min=1), default=ADMET_CONCURRENCY,
+              help="Maximum number of requests to admetlab 3.0 in flight at the same time")
+@click.option("--no_admet_cache", is_flag=True,
+              help="Don't read or write the local cache of admetlab predictions")
+@click.option("--cache_stats", is_flag=True, help="Show the size and hit rate of the admetlab predictions cache")
+@click.option("--cache_prune", type=click.FloatRange(min=0), default=None, metavar="MB",
+              help="Remove the least recently used admetlab predictions until the cache fits in MB megabytes")
+@click.option("--cache_warm", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Fill the admetlab predictions cache with a file with a list of SMILES")
+@click.option("--static_report", is_flag=True,
+              help=f"Write the report as a plain html table with the {MAX_ROWS} best molecules")
 @click.version_option("1.3.3")
 def pharmisa(receptor_file, ligand_file, score, rmsd, pharma, session, plip_csv, slow, process, only_admet, output,
              minmolweight, maxmolweight, minrotbonds, maxrotbonds, minlogp, maxlogp, minpsa, maxpsa, minaromatics,
-             maxaromatics, minhba, maxhba, minhbd, maxhbd, pharmisa_params, fpadmet, firefox):
-    if process and (receptor_file or ligand_file or pharma or session or plip_csv or slow):
+             maxaromatics, minhba, maxhba, minhbd, maxhbd, pharmisa_params, fpadmet, fpadmet_workers,
+             fpadmet_chunk_size, firefox, stream, workers, dedup, top_k, no_cache, sweep, pipeline, admet_concurrency,
+             no_admet_cache, cache_stats, cache_prune, cache_warm, static_report):
+    if cache_stats or cache_prune is not None or cache_warm:
+        exec_admet_cache(cache_stats, cache_prune, cache_warm, admet_concurrency)
+        return
+    if process and (receptor_file or ligand_file or pharma or session or plip_csv or slow or pipeline):
         raise click.BadParameter(
             "You can run --process only with the flags --score and --rmsd.")
 
@@ -70,12 +110,17 @@ def pharmisa(receptor_file, ligand_file, score, rmsd, pharma, session, plip_csv,
                                                                                                         ligand_file)):
         raise click.BadParameter(
             "You must provide either a session or both a receptor file and a ligand file.")
-    if only_admet and (receptor_file or ligand_file or pharma or session or plip_csv or slow or process):
+    if only_admet and (receptor_file or ligand_file or pharma or session or plip_csv or slow or process or pipeline):
         raise click.BadParameter(
             "You can only provide the flag --output with --only_admet")
     if (plip_csv and session) or (plip_csv and pharma):
         raise click.BadParameter(
             "You can't provide a plip csv file with a session or with the pharma flag.")
+    if fpadmet:
+        try:
+            check_fpadmet_models()
+        except FpadmetError as error:
+            raise click.BadParameter(f"{error}. Add them or run without --fpadmet.")
     start_time = time.time()
     pharmit_params = create_dict(minmolweight, maxmolweight, minrotbonds, maxrotbonds, minlogp, maxlogp, minpsa, maxpsa,
                                  minaromatics, maxaromatics, minhba, maxhba, minhbd, maxhbd, pharmisa_params)
@@ -96,18 +141,34 @@ def pharmisa(receptor_file, ligand_file, score, rmsd, pharma, session, plip_csv,
                                                                     plip_csv,
                                                                     output_folder_path, old_download_list,
                                                                     pharmacophore_number, pharmit_params, firefox)
-            minimize_count = exec_pharmisa_search(new_session, phc, output_folder_path, pharmacophore_number,
-                                                  is_plip=plip_csv, fast=fast)
-            exec_pharmisa_process(minimize_count, score, output_folder_path, rmsd, folder_name, start_time,
-                                  fpadmet=fpadmet)
+            sdf_pipeline = SdfPipeline(score, rmsd, dedup_key=dedup, workers=workers, use_cache=not no_cache,
+                                       sweep=sweep).start() if pipeline else None
+            try:
+                minimize_count = exec_pharmisa_search(new_session, phc, output_folder_path, pharmacophore_number,
+                                                      is_plip=plip_csv, fast=fast)
+                exec_pharmisa_process(minimize_count, score, output_folder_path, rmsd, folder_name, start_time,
+                                      fpadmet=fpadmet, fpadmet_workers=fpadmet_workers,
+                                      fpadmet_chunk_size=fpadmet_chunk_size, stream=stream, workers=workers,
+                                      dedup=dedup, top_k=top_k, use_cache=not no_cache, sweep=sweep,
+                                      sdf_pipeline=sdf_pipeline, admet_concurrency=admet_concurrency,
+                                      admet_cache=not no_admet_cache, static_report=static_report)
+            finally:
+                if sdf_pipeline:
+                    sdf_pipeline.close()
         else:
-            exec_pharmisa_process(0, score, output_folder_path, rmsd, folder_name, start_time, only_admet=only_admet)
+            exec_pharmisa_process(0, score, output_folder_path, rmsd, folder_name, start_time, only_admet=only_admet,
+                                  admet_concurrency=admet_concurrency, admet_cache=not no_admet_cache,
+                                  static_report=static_report)
     else:
         folder_name = process.split("/")[-1]
         output_folder_path = create_folders(process, only_process=True)
         create_stats_file(output_folder_path)
         exec_pharmisa_process(0, score, output_folder_path, rmsd, folder_name, start_time, only_process=True,
-                              fpadmet=fpadmet)
+                              fpadmet=fpadmet, fpadmet_workers=fpadmet_workers,
+                              fpadmet_chunk_size=fpadmet_chunk_size, stream=stream, workers=workers,
+                              dedup=dedup, top_k=top_k, use_cache=not no_cache, sweep=sweep,
+                              admet_concurrency=admet_concurrency, admet_cache=not no_admet_cache,
+                              static_report=static_report)
 
 
 def search_prepare(receptor_file, ligand_file, pharma, session, plip_csv, output_folder_path, old_download_list,
@@ -165,9 +226,14 @@ def exec_pharmisa_search(new_session, phc, output_folder_path, pharmacophore_num
 
 
 def exec_pharmisa_process(minimize_count, score, output_folder_path, rmsd, folder_name, start_time,
-                          only_process=False, only_admet=None, fpadmet=False):
+                          only_process=False, only_admet=None, fpadmet=False, fpadmet_workers=FPADMET_WORKERS,
+                          fpadmet_chunk_size=None, stream=False,
+                          workers=1, dedup='smiles', top_k=None, use_cache=True, sweep=False, sdf_pipeline=None,
+                          admet_concurrency=ADMET_CONCURRENCY, admet_cache=True, static_report=False):
     if not only_admet:
-        sdfp = SdfProcessor(minimize_count, output_folder_path, score=score, cli_rmsd=rmsd)
+        sdfp = SdfProcessor(minimize_count, output_folder_path, score=score, cli_rmsd=rmsd, stream=stream,
+                            workers=workers, dedup_key=dedup, top_k=top_k, use_cache=use_cache,
+                            pipeline=sdf_pipeline)
         if not only_process:
             sdfp.get_sdfs()
         else:
@@ -175,7 +241,13 @@ def exec_pharmisa_process(minimize_count, score, output_folder_path, rmsd, folde
                 click.echo(f"\nFolder {output_folder_path} does not exist. Please provide a valid path.")
                 return
             minimized_files = get_minimized_results_files_list(output_folder_path)
-            sdfp.sdf_files = unzip_minimized_results_files(minimized_files)
+            sdfp.sdf_files = unzip_minimized_results_files(minimized_files, stream=stream)
+        if sweep:
+            sweep_df = sdfp.run_threshold_sweep(*get_sweep_grid(score, rmsd))
+            click.echo("\nUnique molecules by score (rows) and RMSD (columns) threshold:\n")
+            click.echo(sweep_df[sweep_df['database'] == 'all'].drop(columns='database').to_string(index=False))
+            click.echo(f"\nThe counts by database are in {output_folder_path}/results/threshold_sweep.csv")
+            return
         try:
             analyzed_mol_dict = sdfp.run_sdfprocessor()
         except ValueError:
@@ -185,23 +257,39 @@ def exec_pharmisa_process(minimize_count, score, output_folder_path, rmsd, folde
         if len(analyzed_mol_dict) > 5000:
             if fpadmet:
                 click.echo(f"\nStarting fpadmet analysis in {len(analyzed_mol_dict)} molecules")
-                analyzed_mol_dict = run_fpadmet(analyzed_mol_dict, output_folder_path)
+                try:
+                    analyzed_mol_dict = run_fpadmet(analyzed_mol_dict, output_folder_path, workers=fpadmet_workers,
+                                                    chunk_size=fpadmet_chunk_size)
+                except FpadmetError as error:
+                    click.echo(f"\nError: the FPADMET analysis failed. {error}")
+                    return
 
     else:
         analyzed_mol_dict = process_smiles_file(only_admet)
+    cache = AdmetCache() if admet_cache else None
     try:
-        molecules_dict_list = run_admet_request(analyzed_mol_dict)
-    except AdmetServerError:
+        journal_path = run_admet_request(analyzed_mol_dict, get_journal_path(output_folder_path),
+                                         concurrency=admet_concurrency, cache=cache)
+    except (AdmetServerError, ConnectionError):
         click.echo("\nError: ADMET server is down. Please try again later using pharmisa --process.")
         return
+    finally:
+        if cache:
+            cache.close()
     click.echo("\nGenerating final results...")
-    analyzer = AdmetAnalyzer(output_folder_path, analyzed_mol_dict, molecules_dict_list)
+    analyzer = AdmetAnalyzer(output_folder_path, analyzed_mol_dict, journal_path)
     try:
         analyzer.run_admet_analyzer()
     except NoMoleculeError:
         click.echo("\nNo molecules passed the admet filter")
         return
-    results_to_html(output_folder_path, folder_name)
+    except AdmetSchemaError as error:
+        click.echo(f"\nError: the admetlab 3.0 results don't match the expected columns. {error}")
+        return
+    if static_report:
+        results_to_html(output_folder_path, folder_name, max_rows=MAX_ROWS, static=True)
+    else:
+        results_to_html(output_folder_path, folder_name)
 
     click.echo(f"\nGo to {output_folder_path} to see the final results")
     elapsed_time = time.time()
@@ -255,5 +343,26 @@ def pharmacophore_selection_menu(jsh):
             jsh.pharma_switch(switch)
 
 
+def exec_admet_cache(cache_stats, cache_prune, cache_warm, admet_concurrency):
+    cache = AdmetCache()
+    try:
+        if cache_warm:
+            found, sent = warm_admet_cache(cache_warm, cache, concurrency=admet_concurrency)
+            click.echo(f"\n{sent} SMILES of {cache_warm} sent to admetlab 3.0, {found} were already in the ADMET cache")
+        if cache_prune is not None:
+            removed = cache.prune(cache_prune)
+            click.echo(f"\n{removed} predictions removed from the ADMET cache")
+        if cache_stats:
+            stats = cache.stats()
+            click.echo(f"\nADMET cache: {stats['path']}\n"
+                       f"Predictions: {stats['entries']} ({stats['size_mb']:.2f} MB, "
+                       f"file {stats['file_size_mb']:.2f} MB)\n"
+                       f"Hit rate: {stats['hit_rate']:.1%} ({stats['hits']} hits, {stats['misses']} misses)")
+    except (AdmetServerError, ConnectionError):
+        click.echo("\nError: ADMET server is down. Please try again later.")
+    finally:
+        cache.close()
+
+
 if __name__ == "__main__":
     pharmisa()
@@ -0,0 +1,81 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from .utils import get_download_list, get_file_name
+from .sdf_processor import scan_shard, scan_shard_hits, _suppress_rdkit_warnings
+
+
+class SdfPipeline:
+    """Parses each minimized_results download in a background process as soon as it is complete,
+    while the pharmit searches of the other databases are still running.
+    SdfProcessor takes the results by file name and only parses the files the pipeline didn't see.
+    The task is the one SdfProcessor will consume: the hits table for the cache and the threshold sweep,
+    the selected records otherwise"""
+    def __init__(self, score: float, cli_rmsd: float, dedup_key: str = 'smiles', workers: int = 1,
+                 use_cache=True, sweep=False):
+        self.task = scan_shard_hits if use_cache or sweep else scan_shard
+        self.score = score
+        self.cli_rmsd = cli_rmsd
+        self.dedup_key = dedup_key
+        self.old_download_list = get_download_list('minimized_results*')
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_suppress_rdkit_warnings)
+        self.futures = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch_downloads, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @staticmethod
+    def _is_complete(file: str):
+        """Chrome writes to a .crdownload file and Firefox to a .part file next to the final one"""
+        return (os.path.isfile(file) and not file.endswith(('.crdownload', '.part'))
+                and not os.path.exists(f"{file}.part") and os.path.getsize(file) > 0)
+
+    def _submit_new_downloads(self):
+        for file in get_download_list('minimized_results*'):
+            file_name = get_file_name(file)
+            if file in self.old_download_list or file_name in self.futures or not self._is_complete(file):
+                continue
+            with self._lock:
+                self.futures[file_name] = self.executor.submit(self.task, (file, 0, None), self.score,
+                                                               self.cli_rmsd, self.dedup_key)
+
+    def _watch_downloads(self):
+        while not self._stop.is_set():
+            self._submit_new_downloads()
+            self._stop.wait(1)
+
+    def stop(self):
+        """Stop watching the download folder, after a last look for finished downloads"""
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+            self._submit_new_downloads()
+
+    def wait_for(self, download_path: str):
+        """Wait until the background parse of a download is over, so the file can be moved to the run folder"""
+        with self._lock:
+            future = self.futures.get(get_file_name(download_path))
+        if future is not None:
+            wait([future])
+
+    def get_result(self, sdf_path: str):
+        """Result of the background parse of a file moved to the run folder (unzipped or not),
+        None if the pipeline didn't parse it"""
+        file_name = get_file_name(sdf_path)
+        with self._lock:
+            future = self.futures.get(file_name) or self.futures.get(f"{file_name}.gz")
+        if future is None:
+            return None
+        result = future.result()
+        if isinstance(result, dict):
+            # The hits table points to the file in the run folder, not to the download
+            result['file'] = [file_name] * len(result['file'])
+        return result
+
+    def close(self):
+        self.stop()
+        self.executor.shutdown(cancel_futures=True)
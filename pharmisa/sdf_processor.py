@@ -1,63 +1,249 @@
+import heapq
+import pandas as pd
 from .utils import *
+from .sdf_scanner import scan_sdf, shard_sdf_files, read_records
+from .threshold_sweep import sweep_counts
+from .dedup_index import DedupIndex, molecule_key
+from .hits_cache import (new_hits_columns, hits_columns_to_df, open_hits_cache, iter_hits_cache, HitsCacheWriter,
+                         filter_hits, guess_database)
+from concurrent.futures import ProcessPoolExecutor
 from rdkit import RDLogger, Chem
 from tqdm import tqdm
 
 
+def record_to_smiles(record: bytes, dedup_key: str = 'smiles'):
+    """Build the RDKit molecule of a raw sdf record and return its (SMILES, dedup key).
+    Returns None if RDKit can't read the record"""
+    mol = Chem.MolFromMolBlock(record.decode('utf-8', errors='replace'), sanitize=False, strictParsing=True)
+    if mol is None:
+        return None
+    smiles = Chem.MolToSmiles(mol, isomericSmiles=False)
+    return smiles, molecule_key(mol, smiles, dedup_key)
+
+
+def _suppress_rdkit_warnings():
+    lg = RDLogger.logger()
+    lg.setLevel(RDLogger.CRITICAL)
+
+
+def scan_shard(shard: tuple, score: float, cli_rmsd: float, dedup_key: str = 'smiles'):
+    """Worker task: returns (mol_ids, score, rmsd, smiles, key) of the records of a shard that fit the threshold.
+    The dedup is left to the main process, which merges the shards in order"""
+    sdf_path, start, end = shard
+    candidates = []
+    for offset, record, mol_ids, mol_score, mol_rmsd in scan_sdf(sdf_path, start, end):
+        if mol_score < score and mol_rmsd <= cli_rmsd:
+            parsed = record_to_smiles(record, dedup_key)
+            if parsed is not None:
+                candidates.append((mol_ids, mol_score, mol_rmsd, *parsed))
+    return candidates
+
+
+def scan_shard_hits(shard: tuple, score: float, cli_rmsd: float, dedup_key: str = 'smiles'):
+    """Worker task for the hits cache: returns the columns of every record of a shard.
+    The SMILES and dedup key are only computed for the records that fit the threshold,
+    the others are filled when a later run needs them. '' marks a record RDKit can't read"""
+    sdf_path, start, end = shard
+    file_name = os.path.basename(sdf_path)
+    hits = new_hits_columns()
+    for offset, record, mol_ids, mol_score, mol_rmsd in scan_sdf(sdf_path, start, end):
+        keys = {'smiles': None, 'canonical': None, 'inchikey': None}
+        if mol_score < score and mol_rmsd <= cli_rmsd:
+            smiles, key = record_to_smiles(record, dedup_key) or ('', '')
+            keys['smiles'] = smiles
+            keys[dedup_key] = key
+        hits['mol_ids'].append(mol_ids)
+        hits['score'].append(mol_score)
+        hits['rmsd'].append(mol_rmsd)
+        hits['database'].append(guess_database(mol_ids))
+        hits['file'].append(file_name)
+        hits['offset'].append(offset)
+        for column, value in keys.items():
+            hits[column].append(value)
+    return hits
+
+
 class SdfProcessor:
     """Selects the best molecules from sdf files"""
-    def __init__(self, minimize_count: int, output_folder_path: str, score: float, cli_rmsd: float):
+    def __init__(self, minimize_count: int, output_folder_path: str, score: float, cli_rmsd: float,
+                 stream=False, workers=1, dedup_key='smiles', top_k: int = None, use_cache=True,
+                 pipeline=None):
         self.output_folder_path = output_folder_path
         self.score = score
         self.cli_rmsd = cli_rmsd
+        self.stream = stream
+        self.workers = workers
+        self.use_cache = use_cache
+        self.pipeline = pipeline
         self.minimize_count = minimize_count
         self.sdf_files = []
         self.best_molecules = []
-        self.analyzed_mol = set()
-        self.smiles_found = []
+        self.top_k = top_k
+        self._top_k_heap = []
+        self._kept_count = 0
+        self.dedup_index = DedupIndex(dedup_key)
 
     def __getitem__(self, index):
         return self.best_molecules[index]
 
     def get_sdfs(self):
         """Get the .sdfs files from download page"""
+        if self.pipeline:
+            self.pipeline.stop()
         last_files = get_last_files(file_pattern='minimized_results*', minimize_count=self.minimize_count)
         if len(last_files) > self.minimize_count:
             n = len(last_files) - self.minimize_count
             last_files = last_files[:-n]
         for file in last_files:
+            if self.pipeline:
+                # The pipeline workers read the file in the download folder
+                self.pipeline.wait_for(file)
             transfer_to_folder(file, self.output_folder_path, 'mv')
             file_name = get_file_name(file)
             zipped_path = f"{self.output_folder_path}/{file_name}"
-            unzipped_path = unzip(zipped_path)
-            self.sdf_files.append(unzipped_path)
+            if self.stream:
+                self.sdf_files.append(zipped_path)
+            else:
+                self.sdf_files.append(unzip(zipped_path))
 
     def _process_sdf(self):
         """Generate dict with Molecule ID: (score, smiles)"""
+        _suppress_rdkit_warnings()
         for file in tqdm(self.sdf_files, desc="Processing Pharmit Results", ncols=100):
-            lg = RDLogger.logger()
-            lg.setLevel(RDLogger.CRITICAL)  # Suppresses RDKit warnings
-            mol_supplier = Chem.SDMolSupplier(file, strictParsing=True, sanitize=False)
-            for index, mol in enumerate(mol_supplier):
-                try:
-                    mol_ids = mol.GetProp("_Name")
-                    mol_ids_set = {i for i in mol_ids.split(' ')}
-                except AttributeError:
-                    continue
-                score = float(mol.GetProp("minimizedAffinity"))
-                rmsd = float(mol.GetProp("minimizedRMSD"))
+            for offset, record, mol_ids, score, rmsd in scan_sdf(file):
+                mol_ids_set = {i for i in mol_ids.split(' ')}
+                # Only the records that pass the threshold are parsed by RDKit
                 if self._mol_check(mol_ids_set, score, rmsd):
-                    smiles = Chem.MolToSmiles(mol, isomericSmiles=False)
-                    if smiles not in self.smiles_found:
-                        self.best_molecules.append((mol_ids, score, rmsd, smiles))
-                        self.analyzed_mol = self.analyzed_mol.union(mol_ids_set)
-                        self.smiles_found.append(smiles)
-                else:
+                    parsed = record_to_smiles(record, self.dedup_index.dedup_key)
+                    if parsed is not None:
+                        self._add_molecule(mol_ids, mol_ids_set, score, rmsd, *parsed)
+
+    def _map_shards(self, task, score: float, cli_rmsd: float):
+        """Yield the result of a scan task (scan_shard or scan_shard_hits) for each shard of the sdf files,
+        in file order. With more than one worker the shards run in a process pool, and the files already
+        parsed by the pipeline during the search with the same task are not parsed again"""
+        key = self.dedup_index.dedup_key
+        _suppress_rdkit_warnings()
+        if self.pipeline and self.pipeline.task is task:
+            for file in tqdm(self.sdf_files, desc="Processing Pharmit Results", ncols=100):
+                result = self.pipeline.get_result(file)
+                yield result if result is not None else task((file, 0, None), score, cli_rmsd, key)
+            return
+        if self.workers > 1:
+            shards = shard_sdf_files(self.sdf_files, self.workers)
+        else:
+            shards = [(file, 0, None) for file in self.sdf_files]
+        n_shards = len(shards)
+        args = (shards, [score] * n_shards, [cli_rmsd] * n_shards, [key] * n_shards)
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_suppress_rdkit_warnings) as executor:
+                yield from tqdm(executor.map(task, *args), total=n_shards, desc="Processing Pharmit Results",
+                                ncols=100)
+        else:
+            yield from tqdm(map(task, *args), total=n_shards, desc="Processing Pharmit Results", ncols=100)
+
+    def _process_sdf_shards(self):
+        """Same as _process_sdf, with the parsing and SMILES generation of each shard done by a process pool
+        or by the pipeline. The shards are merged in file order, so the dedup gives the same molecules as the
+        serial run"""
+        for candidates in self._map_shards(scan_shard, self.score, self.cli_rmsd):
+            for mol_ids, score, rmsd, smiles, key in candidates:
+                mol_ids_set = {i for i in mol_ids.split(' ')}
+                if self._mol_check(mol_ids_set, score, rmsd):
+                    self._add_molecule(mol_ids, mol_ids_set, score, rmsd, smiles, key)
+
+    def _process_sdf_cached(self):
+        """Select the molecules from the hits table cached in the run folder, building it on the first run.
+        The threshold is applied to a whole shard of the table at once and only the selected rows are deduplicated"""
+        key_column = self.dedup_index.dedup_key
+        for selected in self._iter_hits(self.score, self.cli_rmsd):
+            for mol_ids, score, rmsd, smiles, key in zip(selected['mol_ids'], selected['score'], selected['rmsd'],
+                                                         selected['smiles'], selected[key_column]):
+                if not smiles:
                     continue
+                mol_ids_set = {i for i in mol_ids.split(' ')}
+                if self._mol_check(mol_ids_set, score, rmsd):
+                    self._add_molecule(mol_ids, mol_ids_set, score, rmsd, smiles, key)
+
+    def _iter_hits(self, score: float, cli_rmsd: float):
+        """Yield the rows of the hits table that fit the threshold, with their SMILES and dedup key, one shard
+        at a time and in file order. The table is read from the cache when there is one, else the sdf files are
+        scanned. The cache is written shard by shard, when it is new or when anything was added to it,
+        so only one shard of the table is in memory at a time"""
+        cache = open_hits_cache(self.output_folder_path, self.sdf_files) if self.use_cache else None
+        if cache is None:
+            shards = (hits_columns_to_df(columns) for columns in self._map_shards(scan_shard_hits, score, cli_rmsd))
+            writer = HitsCacheWriter(self.output_folder_path, self.sdf_files) if self.use_cache else None
+        else:
+            shards = iter_hits_cache(cache)
+            writer = None
+        try:
+            for index, hits_df in enumerate(shards):
+                selected = filter_hits(hits_df, score, cli_rmsd)
+                missing = selected.index[selected[self.dedup_index.dedup_key].isna().values]
+                if len(missing):
+                    self._fill_hits_smiles(hits_df, missing)
+                    selected = hits_df.loc[selected.index]
+                    if writer is None:
+                        # The cache is rewritten from its first row group on the first one that changes
+                        writer = HitsCacheWriter(self.output_folder_path, self.sdf_files)
+                        for previous_df in iter_hits_cache(cache, stop=index):
+                            writer.write(previous_df)
+                if writer is not None:
+                    writer.write(hits_df)
+                yield selected
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        finally:
+            if cache is not None:
+                cache.close()
+        if writer is not None:
+            writer.close()
+
+    def _fill_hits_smiles(self, hits_df, rows):
+        """Compute the SMILES and dedup key of cached rows that were out of the threshold of the previous runs"""
+        _suppress_rdkit_warnings()
+        key_column = self.dedup_index.dedup_key
+        sdf_paths = {os.path.basename(file): file for file in self.sdf_files}
+        missing = hits_df.loc[rows, ['file', 'offset']]
+        for file_name, file_rows in missing.groupby('file', sort=False):
+            row_by_offset = dict(zip(file_rows['offset'], file_rows.index))
+            for offset, record in tqdm(read_records(sdf_paths[file_name], row_by_offset), total=len(row_by_offset),
+                                       desc=f"Reading new hits of {file_name}", ncols=100):
+                smiles, key = record_to_smiles(record, key_column) or ('', '')
+                row = row_by_offset[offset]
+                hits_df.at[row, 'smiles'] = smiles
+                hits_df.at[row, key_column] = key
+
+    def _add_molecule(self, mol_ids: str, mol_ids_set: set, score: float, rmsd: float, smiles: str, key: str):
+        if key not in self.dedup_index:
+            self._keep_molecule((mol_ids, score, rmsd, smiles))
+            self.dedup_index.add(key, mol_ids_set)
+
+    def _keep_molecule(self, molecule: tuple):
+        """Append the molecule to best_molecules or, in top-k mode, push it to a heap of the k best molecules.
+        The root of the heap is the worst kept molecule: highest score, then highest RMSD, then the latest seen"""
+        if not self.top_k:
+            self.best_molecules.append(molecule)
+            return
+        entry = (-molecule[1], -molecule[2], -self._kept_count, molecule)
+        self._kept_count += 1
+        if len(self._top_k_heap) < self.top_k:
+            heapq.heappush(self._top_k_heap, entry)
+        else:
+            heapq.heappushpop(self._top_k_heap, entry)
+
+    def _collect_top_k(self):
+        """Best molecules of the heap, sorted by score and RMSD"""
+        self.best_molecules = [entry[3] for entry in sorted(self._top_k_heap, reverse=True)]
+        self._top_k_heap = []
 
     def _mol_check(self, mol_ids_set: set, score: float, rmsd: float) -> bool:
-        """Check if the molecule is already in the analyzed_mol
-        set and if it fits the threshold (score < input_score and rmsd < input_rmsd)"""
-        if not mol_ids_set.intersection(self.analyzed_mol):
+        """Check if the molecule ids are already in the dedup index
+        and if it fits the threshold (score < input_score and rmsd < input_rmsd)"""
+        if not self.dedup_index.has_ids(mol_ids_set):
             if score < self.score and rmsd <= self.cli_rmsd:
                 return True
 
@@ -65,12 +251,31 @@ class SdfProcessor:
         """Returns a dict with the top best molecules"""
         return {mol[0]: {'score': mol[1], 'rmsd': mol[2], 'smiles': mol[3]} for mol in self.best_molecules}
 
+    def run_threshold_sweep(self, scores: list, rmsds: list):
+        """Count the unique molecules surviving each score/RMSD cut-off of the grid, reading the sdf files once.
+        The table is saved in results/threshold_sweep.csv"""
+        frames = list(self._iter_hits(max(scores), max(rmsds)))
+        selected = pd.concat(frames, ignore_index=True) if frames else hits_columns_to_df(new_hits_columns())
+        sweep_df = sweep_counts(selected, scores, rmsds, self.dedup_index.dedup_key)
+        sweep_df.to_csv(f"{self.output_folder_path}/results/threshold_sweep.csv", index=False)
+        return sweep_df
+
     def run_sdfprocessor(self):
-        self._process_sdf()
+        if self.use_cache:
+            self._process_sdf_cached()
+        elif self.workers > 1 or self.pipeline:
+            self._process_sdf_shards()
+        else:
+            self._process_sdf()
+        if self.top_k:
+            self._collect_top_k()
         if self.best_molecules:
             write_stats(f"\n\nNumber of molecules after filtering (Score < {self.score} and RMSD < {self.cli_rmsd}): "
                         f"{len(self.best_molecules)}", self.output_folder_path)
-            write_stats(f"\nBest score found: {self.best_molecules[0]}", self.output_folder_path)
+            if self.top_k:
+                write_stats(f" (top {self.top_k} of {self._kept_count})", self.output_folder_path)
+            best_molecule = min(self.best_molecules, key=lambda mol: (mol[1], mol[2]))
+            write_stats(f"\nBest score found: {best_molecule}", self.output_folder_path)
         else:
             raise ValueError('No molecules that fit the threshold found in the .sdf files')
         
@@ -0,0 +1,141 @@
+import os
+import re
+from .utils import open_sdf
+
+RECORD_DELIMITER = b'$$$$'
+CHUNK_SIZE = 1 << 20
+SHARD_SIZE = 64 << 20
+MIN_SHARD_SIZE = 4 << 20
+AFFINITY_PATTERN = re.compile(rb'>\s*<minimizedAffinity>[^\n]*\n([^\n]*)')
+RMSD_PATTERN = re.compile(rb'>\s*<minimizedRMSD>[^\n]*\n([^\n]*)')
+
+
+def _strip_line_break(record: bytes):
+    """Remove the line break left by the $$$$ delimiter, keeping an empty name line intact"""
+    if record.startswith(b'\r\n'):
+        return record[2:]
+    if record.startswith(b'\n'):
+        return record[1:]
+    return record
+
+
+def iter_sdf_records(sdf_stream, chunk_size: int = CHUNK_SIZE, limit: int = None, offset: int = 0):
+    """Yield (offset, record) for each record of a binary sdf stream, split on the $$$$ lines.
+    offset is the position of the stream when called. If limit is given, only that many bytes are read"""
+    buffer = b''
+    buffer_offset = offset
+    first_record = True
+    while limit is None or limit > 0:
+        chunk = sdf_stream.read(chunk_size if limit is None else min(chunk_size, limit))
+        if not chunk:
+            break
+        if limit is not None:
+            limit -= len(chunk)
+        buffer += chunk
+        records = buffer.split(RECORD_DELIMITER)
+        buffer = records.pop()
+        for record in records:
+            record_offset = buffer_offset
+            buffer_offset += len(record) + len(RECORD_DELIMITER)
+            if not first_record:
+                stripped = _strip_line_break(record)
+                record_offset += len(record) - len(stripped)
+                record = stripped
+            first_record = False
+            yield record_offset, record
+    if not first_record:
+        stripped = _strip_line_break(buffer)
+        buffer_offset += len(buffer) - len(stripped)
+        buffer = stripped
+    if buffer.strip():
+        yield buffer_offset, buffer
+
+
+def read_records(sdf_path: str, offsets):
+    """Yield (offset, record) for the records starting at the given offsets, read in ascending order
+    so a compressed file is only decompressed once"""
+    with open_sdf(sdf_path) as sdf_stream:
+        for offset in sorted(offsets):
+            sdf_stream.seek(offset)
+            lines = []
+            for line in iter(sdf_stream.readline, b''):
+                if line.startswith(RECORD_DELIMITER):
+                    break
+                lines.append(line)
+            yield offset, b''.join(lines)
+
+
+def read_record_fields(record: bytes):
+    """Read (_Name, minimizedAffinity, minimizedRMSD) from the raw text of a record.
+    Returns None if the record does not have both properties"""
+    affinity = AFFINITY_PATTERN.search(record)
+    rmsd = RMSD_PATTERN.search(record)
+    if not affinity or not rmsd:
+        return None
+    name_end = record.find(b'\n')
+    name = record[:name_end] if name_end != -1 else record
+    name = name.rstrip(b'\r').decode('utf-8', errors='replace')
+    return name, float(affinity.group(1)), float(rmsd.group(1))
+
+
+def _find_record_start(sdf_stream, offset: int):
+    """Return the offset of the first record starting at or after offset"""
+    sdf_stream.seek(offset)
+    position = offset
+    buffer = b''
+    while True:
+        chunk = sdf_stream.read(CHUNK_SIZE)
+        if not chunk:
+            return None
+        buffer += chunk
+        delimiter = buffer.find(RECORD_DELIMITER)
+        line_end = buffer.find(b'\n', delimiter) if delimiter != -1 else -1
+        if line_end != -1:
+            return position + line_end + 1
+        # Keep the tail in case the delimiter was cut between two chunks
+        position += max(len(buffer) - len(RECORD_DELIMITER) - 1, 0)
+        buffer = buffer[-(len(RECORD_DELIMITER) + 1):]
+
+
+def shard_sdf_file(sdf_path: str, shard_size: int = SHARD_SIZE):
+    """Split a sdf file in (path, start, end) byte ranges aligned to the $$$$ lines.
+    Compressed files can't be read from the middle, so they are a single shard"""
+    file_size = os.path.getsize(sdf_path)
+    if sdf_path.endswith('.gz') or file_size <= shard_size:
+        return [(sdf_path, 0, None)]
+    boundaries = [0]
+    with open(sdf_path, 'rb') as sdf_stream:
+        for offset in range(shard_size, file_size, shard_size):
+            if offset <= boundaries[-1]:
+                continue
+            record_start = _find_record_start(sdf_stream, offset)
+            if record_start is None or record_start >= file_size:
+                break
+            boundaries.append(record_start)
+    boundaries.append(None)
+    return [(sdf_path, start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def shard_sdf_files(sdf_files: list, workers: int):
+    """Shards of all the sdf files, in file order, small enough to keep every worker busy"""
+    total_size = sum(os.path.getsize(file) for file in sdf_files if not file.endswith('.gz'))
+    shard_size = max(MIN_SHARD_SIZE, min(SHARD_SIZE, total_size // (workers * 4) + 1))
+    shards = []
+    for file in sdf_files:
+        shards.extend(shard_sdf_file(file, shard_size))
+    return shards
+
+
+def scan_sdf(sdf_path: str, start: int = 0, end: int = None):
+    """Yield (offset, record, _Name, minimizedAffinity, minimizedRMSD) for each record of a .sdf or .sdf.gz file.
+    The offset is the position of the record in the uncompressed file.
+    start and end restrict the scan to a byte range given by shard_sdf_file"""
+    with open_sdf(sdf_path) as sdf_stream:
+        if start:
+            sdf_stream.seek(start)
+        limit = end - start if end is not None else None
+        for offset, record in iter_sdf_records(sdf_stream, limit=limit, offset=start):
+            fields = read_record_fields(record)
+            if fields is None:
+                continue
+            yield (offset, record, *fields)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+SWEEP_SCORES = [-13.0, -12.5, -12.0, -11.5, -11.0, -10.5, -10.0, -9.5, -9.0, -8.5, -8.0, -7.5, -7.0, -6.5, -6.0]
+SWEEP_RMSDS = [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 5.0, 20.0]
+
+
+def get_sweep_grid(score: float = None, cli_rmsd: float = None):
+    """Default grid of cut-offs, including the ones given in the command line"""
+    scores = sorted(set(SWEEP_SCORES) | ({score} if score is not None else set()))
+    rmsds = sorted(set(SWEEP_RMSDS) | ({cli_rmsd} if cli_rmsd is not None else set()))
+    return scores, rmsds
+
+
+def _count_unique_keys(score_bins: np.ndarray, rmsd_bins: np.ndarray, keys: np.ndarray, shape: tuple):
+    """Number of distinct keys in each cell of the grid, where a row counts for every cell (i, j)
+    with i >= its score bin and j >= its rmsd bin.
+    Each key adds +1 on the corners of the staircase formed by its Pareto-optimal rows and -1 where two
+    consecutive steps meet, so a single 2D cumulative sum gives the counts of all cells"""
+    delta = np.zeros((shape[0] + 1, shape[1] + 1), dtype=np.int64)
+    if len(keys) == 0:
+        return delta[:-1, :-1]
+    rows = pd.DataFrame({'key': keys, 'i': score_bins, 'j': rmsd_bins}).sort_values(['key', 'i', 'j'],
+                                                                                     kind='stable')
+    group = rows.groupby('key', sort=False)['j']
+    previous_min = group.cummin().groupby(rows['key'], sort=False).shift(1)
+    front = rows[previous_min.isna().values | (rows['j'].values < previous_min.values)]
+    np.add.at(delta, (front['i'].values, front['j'].values), 1)
+    same_key = front['key'].values[1:] == front['key'].values[:-1]
+    corner_i = front['i'].values[1:][same_key]
+    corner_j = front['j'].values[:-1][same_key]
+    np.add.at(delta, (corner_i, corner_j), -1)
+    return delta.cumsum(axis=0).cumsum(axis=1)[:-1, :-1]
+
+
+def sweep_counts(hits_df: pd.DataFrame, scores: list, rmsds: list, key_column: str = 'smiles'):
+    """Unique molecules (by dedup key) surviving each score/RMSD cut-off, in total and per database.
+    A cell counts the rows with score < score cut-off and rmsd <= RMSD cut-off, as SdfProcessor._mol_check.
+    SdfProcessor also drops molecules whose ids were already selected, so its counts can be a bit lower.
+    Returns a DataFrame with the columns database, score and one column per RMSD cut-off"""
+    hits_df = hits_df[hits_df['smiles'].fillna('').astype(bool)]
+    # First cut-off index each row survives
+    score_bins = np.searchsorted(np.asarray(scores), hits_df['score'].values, side='right')
+    rmsd_bins = np.searchsorted(np.asarray(rmsds), hits_df['rmsd'].values, side='left')
+    inside = (score_bins < len(scores)) & (rmsd_bins < len(rmsds))
+    hits_df = hits_df[inside]
+    score_bins, rmsd_bins = score_bins[inside], rmsd_bins[inside]
+    keys = hits_df[key_column].values
+    databases = hits_df['database'].values
+    tables = [('all', _count_unique_keys(score_bins, rmsd_bins, keys, (len(scores), len(rmsds))))]
+    for database in sorted(set(databases)):
+        mask = databases == database
+        tables.append((database, _count_unique_keys(score_bins[mask], rmsd_bins[mask], keys[mask],
+                                                    (len(scores), len(rmsds)))))
+    frames = []
+    for database, counts in tables:
+        frame = pd.DataFrame(counts, columns=[f'RMSD <= {rmsd}' for rmsd in rmsds])
+        frame.insert(0, 'score', [f'< {score}' for score in scores])
+        frame.insert(0, 'database', database)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
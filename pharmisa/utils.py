@@ -49,7 +49,10 @@ def get_minimized_results_files_list(directory_path):
     return absolute_paths
 
 
-def unzip_minimized_results_files(files_list: list):
+def unzip_minimized_results_files(files_list: list, stream=False):
+    """Unzip the .sdf.gz files. With stream the .gz files are kept and parsed directly"""
+    if stream:
+        return list(files_list)
     unzipped_files = []
     for file in files_list:
         if file.endswith('.gz'):
@@ -114,6 +117,13 @@ def unzip(zipped_path):
     return unzipped_path
 
 
+def open_sdf(sdf_path: str):
+    """Open a .sdf or .sdf.gz file as a binary stream, decompressing on the fly"""
+    if sdf_path.endswith('.gz'):
+        return gzip.open(sdf_path, 'rb')
+    return open(sdf_path, 'rb')
+
+
 def get_download_list(file_pattern: str):
     cmd_1 = "xdg-user-dir DOWNLOAD"
     download_directory_path = os.popen(cmd_1).read()
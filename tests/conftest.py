@@ -0,0 +1,35 @@
+import asyncio
+import threading
+import pandas as pd
+import pytest
+from pharmisa import admet_request
+from pharmisa.admet_benchmark import generate_smiles
+from pharmisa.admet_fake_server import FakeAdmetServer, predict
+from pharmisa.admet_schema import get_response_groups, get_result_columns, get_result_groups, RENAMED_COLUMNS
+
+
+@pytest.fixture
+def results_table():
+    """Results table of 50 fake admetlab predictions, as AdmetAnalyzer builds it, and its groups"""
+    mol_list = [{**predict(smiles), 'id': f"Molecule_{i + 1}"} for i, smiles in enumerate(generate_smiles(50))]
+    admet_df = pd.DataFrame(mol_list)
+    groups = get_response_groups(admet_df.columns.tolist())
+    admet_df = admet_df[get_result_columns(groups)].rename(columns=RENAMED_COLUMNS)
+    return admet_df, get_result_groups(groups)
+
+
+@pytest.fixture
+def fake_admet_server():
+    """Fake admetlab server served from a thread, for run_admet_request which runs its own event loop"""
+    loop = asyncio.new_event_loop()
+    server = FakeAdmetServer()
+    admet_request.set_admet_url(loop.run_until_complete(server.start()))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(server.stop())
+        loop.close()
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import pytest
+from rdkit import RDLogger, rdBase
+from pharmisa import admet_journal, admet_request
+from pharmisa.admet_benchmark import generate_smiles
+from pharmisa.admet_fake_server import FakeAdmetServer
+from pharmisa.admet_journal import iter_journal
+
+FAST_RETRIES = {'backoff_base': 0.01, 'breaker_pause': 0.05, 'show_progress': False}
+
+
+@pytest.mark.parametrize('response', [{'data': None}, {'data': {'data': None}}, {'data': {'data': [None]}}, None,
+                                      {'code': 500}])
+def test_read_mol_list_rejects_malformed_responses(response):
+    with pytest.raises(ValueError):
+        admet_request.read_mol_list(response, ['Molecule_1'])
+
+
+def test_malformed_responses_are_retried():
+    async def run():
+        server = FakeAdmetServer(malformed_rate=0.3, seed=1)
+        admet_request.set_admet_url(await server.start())
+        received = []
+        items = [(f"Molecule_{i + 1}", smiles) for i, smiles in enumerate(generate_smiles(60))]
+        try:
+            # With 30% of malformed answers a molecule can fail max_retries times in a row, give it more tries
+            scheduler = await admet_request._run_admet_batches(items, 1, received.extend, batch_size=5,
+                                                               max_retries=8, **FAST_RETRIES)
+        finally:
+            await server.stop()
+        return server, scheduler, received
+
+    server, scheduler, received = asyncio.run(run())
+    assert server.stats['malformed'] > 0
+    assert scheduler.retries >= server.stats['malformed']
+    assert not scheduler.skipped
+    assert sorted(mol['id'] for mol in received) == sorted(f"Molecule_{i + 1}" for i in range(60))
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_shared_predictions_keep_the_smiles_of_each_id(tmp_path, fake_admet_server, cached):
+    molecules = {'Molecule_1': {'smiles': 'OCC'}, 'Molecule_2': {'smiles': 'C(O)C'}, 'Molecule_3': {'smiles': 'CCN'}}
+    cache = admet_request.AdmetCache(str(tmp_path / 'cache.sqlite'))
+    if cached:
+        cache.put_many({admet_request.canonical_smiles('CCO'): {'smiles': 'CCO', 'QED': 0.5}})
+    journal_path = str(tmp_path / 'admet_journal.jsonl')
+    try:
+        admet_request.run_admet_request(molecules, journal_path, cache=cache)
+    finally:
+        cache.close()
+    journal = {mol['id']: mol for chunk in iter_journal(journal_path) for mol in chunk}
+    assert {key: mol['smiles'] for key, mol in journal.items()} == {key: mol['smiles']
+                                                                    for key, mol in molecules.items()}
+    assert journal['Molecule_1']['QED'] == journal['Molecule_2']['QED']
+
+
+@pytest.mark.parametrize('warnings_enabled', [False, True])
+def test_canonical_smiles_keep_the_rdkit_log_state(warnings_enabled):
+    (RDLogger.EnableLog if warnings_enabled else RDLogger.DisableLog)('rdApp.warning')
+    log_status = rdBase.LogStatus()
+    try:
+        cache_keys, cached, missing_groups = admet_request._get_cached(
+            {'Molecule_1': {'smiles': 'C1CC'}, 'Molecule_2': {'smiles': 'OCC'}}, None)
+        assert list(cache_keys.values()) == ['C1CC', 'CCO']
+        assert rdBase.LogStatus() == log_status
+    finally:
+        RDLogger.EnableLog('rdApp.warning')
+
+
+@pytest.mark.parametrize('tail_size', [admet_journal.JOURNAL_TAIL_SIZE, 16])
+def test_resume_after_a_torn_last_line(tmp_path, fake_admet_server, monkeypatch, tail_size):
+    monkeypatch.setattr(admet_journal, 'JOURNAL_TAIL_SIZE', tail_size)
+    molecules = {f"Molecule_{i + 1}": {'smiles': smiles} for i, smiles in enumerate(generate_smiles(30))}
+    journal_path = str(tmp_path / 'admet_journal.jsonl')
+    admet_request.run_admet_request(molecules, journal_path)
+    # A crash in the middle of the last line
+    with open(journal_path, 'rb+') as journal:
+        lines = journal.read().splitlines(keepends=True)
+        journal.truncate(sum(len(line) for line in lines[:-1]) + len(lines[-1]) // 2)
+    sent = fake_admet_server.stats['molecules']
+
+    admet_request.run_admet_request(molecules, journal_path)
+    assert fake_admet_server.stats['molecules'] - sent == 1
+    with open(journal_path) as journal:
+        journal_ids = [json.loads(line)['id'] for line in journal]
+    assert sorted(journal_ids) == sorted(molecules)
+    assert journal_ids[-1] == json.loads(lines[-1])['id']
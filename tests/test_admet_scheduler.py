@@ -0,0 +1,40 @@
+import asyncio
+import time
+from pharmisa import admet_scheduler
+from pharmisa.admet_scheduler import AdmetScheduler
+
+POISON = 'C1CC'
+BACKOFF_BASE = 0.05
+
+
+def test_poisoned_batches_are_split_and_retried_after_their_backoff(monkeypatch):
+    # Always the longest backoff, so the wait before each retry is known
+    monkeypatch.setattr(admet_scheduler.random, 'uniform', lambda low, high: high)
+    sends = []
+
+    async def send_batch(batch):
+        start = time.monotonic()
+        await asyncio.sleep(0.002)
+        sends.append((start, time.monotonic(), [key for key, smiles in batch]))
+        if any(smiles == POISON for key, smiles in batch):
+            raise ValueError('Invalid response')
+        return [{'id': key, 'smiles': smiles} for key, smiles in batch]
+
+    items = [(f'Molecule_{i + 1}', 'C' * (i + 1)) for i in range(40)]
+    items[12] = ('Molecule_13', POISON)
+    scheduler = AdmetScheduler(send_batch, concurrency=4, batch_size=8, max_retries=3, backoff_base=BACKOFF_BASE,
+                               show_progress=False)
+    results = asyncio.run(scheduler.run(items))
+
+    assert scheduler.skipped == ['Molecule_13']
+    assert sorted(results) == sorted(key for key, smiles in items if key != 'Molecule_13')
+    # The poisoned batch is halved down to the poisoned SMILES, each retry after the backoff of its attempt
+    poisoned = [send for send in sends if 'Molecule_13' in send[2]]
+    assert [len(keys) for start, end, keys in poisoned] == [8, 4, 2, 1]
+    for attempts, (failed, retry) in enumerate(zip(poisoned, poisoned[1:])):
+        assert retry[0] - failed[1] >= BACKOFF_BASE * 2 ** attempts
+    # The clean half of a split batch waits for the backoff too
+    clean_halves = [start for start, end, keys in sends
+                    if set(keys) < set(poisoned[0][2]) and 'Molecule_13' not in keys]
+    assert clean_halves
+    assert min(clean_halves) - poisoned[0][1] >= BACKOFF_BASE
@@ -0,0 +1,42 @@
+import pandas as pd
+import pytest
+from pharmisa.admet_fake_server import ADMETLAB_COLUMNS
+from pharmisa.admet_schema import get_response_groups, to_compact, write_compact, read_compact, RESPONSE_GROUPS
+from pharmisa.exceptions import AdmetSchemaError
+from pharmisa.get_html import Scorer, to_scoring_types
+
+
+def test_compact_table_keeps_the_scored_values(tmp_path, results_table):
+    admet_df, result_groups = results_table
+    # Values on the thresholds of the scoring
+    admet_df.loc[:9, 'QED'] = 0.67
+    admet_df.loc[:9, 'logVDss'] = 0.04
+    parquet_path = str(tmp_path / 'admet_filtered.parquet')
+    write_compact(to_compact(admet_df, result_groups), result_groups, parquet_path)
+    compact_df, groups = read_compact(parquet_path)
+    compact_df = to_scoring_types(compact_df)
+    assert groups == result_groups
+
+    float_columns = [column for column in admet_df.columns if admet_df[column].dtype == 'float64']
+    assert float_columns
+    pd.testing.assert_frame_equal(compact_df[float_columns], admet_df[float_columns])
+    scorer = Scorer(groups)
+    expected = to_scoring_types(to_compact(admet_df, result_groups))
+    expected[float_columns] = admet_df[float_columns]
+    pd.testing.assert_frame_equal(scorer.score(compact_df), scorer.score(expected))
+
+
+def test_response_groups_are_picked_by_name(capsys):
+    columns = ADMETLAB_COLUMNS + ['id']
+    groups = get_response_groups(columns)
+    assert groups == RESPONSE_GROUPS
+    # A column moved or added by admetlab doesn't shift the groups, the unknown column is reported
+    moved = [columns[0], 'New_column', *reversed(columns[1:])]
+    assert get_response_groups(moved) == groups
+    assert 'New_column' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('column', ['QED', 'SR-p53', 'Toxicophores', 'id'])
+def test_missing_response_columns_are_refused(column):
+    with pytest.raises(AdmetSchemaError, match=column):
+        get_response_groups([name for name in ADMETLAB_COLUMNS + ['id'] if name != column])
@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+from pharmisa import fpadmet
+from pharmisa.admet_benchmark import generate_smiles
+from pharmisa.exceptions import FpadmetError
+
+
+@pytest.fixture
+def models_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(fpadmet, 'get_fpadmet_path', lambda: tmp_path)
+    (tmp_path / 'MODELS').mkdir()
+    return tmp_path / 'MODELS'
+
+
+def test_missing_models_are_reported(models_path):
+    for fingerprint_type, model_file in list(fpadmet.ENDPOINTS.values())[1:]:
+        (models_path / model_file).touch()
+    with pytest.raises(FpadmetError, match=fpadmet.ENDPOINTS[fpadmet.TOX_PARAMETERS[0]][1]):
+        fpadmet.check_fpadmet_models()
+    with pytest.raises(FpadmetError):
+        fpadmet.run_fpadmet({'Molecule_1': {'smiles': 'CCO'}}, str(models_path.parent))
+    assert not (models_path.parent / 'fpadmet_smiles.smi').exists()
+
+    (models_path / fpadmet.ENDPOINTS[fpadmet.TOX_PARAMETERS[0]][1]).touch()
+    fpadmet.check_fpadmet_models()
+
+
+def fake_predict_smi_file(fpadmet_path, smi_file, tox_parameters, scratch_path, prediction_pool, *args, **kwargs):
+    """Predictions with few distinct scores, so most molecules tie"""
+    rows = []
+    with open(smi_file) as smi_f:
+        for line in smi_f:
+            smiles, code = line.rstrip('\n').split('\t')
+            flag = len(smiles) % 3 == 0
+            rows.append({'Molecule': code, **{f'Predicted_{parameter}': list(fpadmet.TOX_TO_NUMBER[
+                f'Predicted_{parameter}'])[flag and parameter == 4] for parameter in tox_parameters}})
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('chunk_size', [7, 100, 1000])
+def test_chunked_and_whole_runs_keep_the_same_molecules(tmp_path, monkeypatch, chunk_size):
+    monkeypatch.setattr(fpadmet, 'check_fpadmet_models', lambda: None)
+    monkeypatch.setattr(fpadmet, 'predict_smi_file', fake_predict_smi_file)
+    monkeypatch.setattr(fpadmet, 'FPADMET_TOP', 40)
+    dict_final = {f'Molecule_{i}': {'smiles': smiles} for i, smiles in enumerate(generate_smiles(300))}
+    kept = {}
+    for mode, mode_chunk_size in [('whole', None), ('chunked', chunk_size)]:
+        output_folder_path = tmp_path / mode
+        (output_folder_path / 'results').mkdir(parents=True)
+        kept[mode] = list(fpadmet.run_fpadmet(dict(dict_final), str(output_folder_path),
+                                              chunk_size=mode_chunk_size))
+        sorted_df = pd.read_csv(output_folder_path / 'results' / 'fpadmet_results_sorted.csv')
+        kept[f'{mode} sorted'] = sorted_df['Molecule'].tolist()
+    assert len(kept['whole']) == 40
+    assert kept['whole'] == kept['chunked']
+    assert kept['whole sorted'] == kept['chunked sorted']
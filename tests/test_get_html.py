@@ -0,0 +1,46 @@
+import json
+import os
+import re
+import pandas as pd
+from pharmisa.admet_schema import get_result_groups, to_compact, write_compact, RESPONSE_GROUPS
+from pharmisa.get_html import ReportBuilder, results_to_html
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def test_report_loads_data_file_with_any_folder_name(tmp_path, results_table):
+    admet_df, result_groups = results_table
+    folder_name = """a&b 'c' "d" <!--<script>"""
+    (tmp_path / 'results').mkdir()
+    write_compact(to_compact(admet_df, result_groups), result_groups,
+                  str(tmp_path / 'results' / 'admet_filtered.parquet'))
+    html_path = results_to_html(str(tmp_path), folder_name)
+
+    report = open(html_path).read()
+    script = report[report.rindex('<script>'):]
+    assert script.count('</script') == 1
+    data_file_literal = re.search(r'var DATA_FILE = (.*);', script).group(1)
+    assert '<' not in data_file_literal
+    data_file = json.loads(data_file_literal)
+    assert data_file == f"{folder_name}_results_data.js"
+    assert (tmp_path / 'results' / data_file).is_file()
+
+
+def test_scores_and_colors_match_the_baseline_report(tmp_path):
+    """report_scores.csv and report_colors.csv (0 no color, 1 green, 2 yellow, 3 red) are the output of the
+    get_html module before the report was vectorized, on admet_filtered.csv. The table has values on the
+    thresholds of the scores and of the colors"""
+    admet_df = pd.read_csv(os.path.join(DATA_PATH, 'admet_filtered.csv'))
+    result_groups = get_result_groups(RESPONSE_GROUPS)
+    (tmp_path / 'results').mkdir()
+    write_compact(to_compact(admet_df, result_groups), result_groups,
+                  str(tmp_path / 'results' / 'admet_filtered.parquet'))
+    builder = ReportBuilder(str(tmp_path), 'run')
+    df_html = builder.scorer.score(builder.results_df)
+
+    expected_scores = pd.read_csv(os.path.join(DATA_PATH, 'report_scores.csv'), float_precision='round_trip')
+    pd.testing.assert_frame_equal(df_html[expected_scores.columns], expected_scores, check_exact=True)
+    expected_colors = pd.read_csv(os.path.join(DATA_PATH, 'report_colors.csv'))
+    assert list(df_html.columns) == list(expected_colors.columns)
+    colors = pd.DataFrame({column: builder.color_codes(column, df_html[column]) for column in df_html.columns})
+    pd.testing.assert_frame_equal(colors, expected_colors, check_dtype=False)
@@ -0,0 +1,225 @@
+import glob
+import gzip
+import os
+import random
+import shutil
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from rdkit import Chem, RDLogger
+from rdkit.Chem import AllChem
+from pharmisa import sdf_pipeline, sdf_processor, sdf_scanner
+from pharmisa.hits_cache import get_cache_path, guess_database
+from pharmisa.sdf_pipeline import SdfPipeline
+from pharmisa.sdf_processor import SdfProcessor
+
+SMILES = ['CCO', 'OCC', 'c1ccccc1O', 'CC(=O)Nc1ccc(O)cc1', 'CCN(CC)CC', 'C[C@H](N)C(=O)O', 'C[C@@H](N)C(=O)O',
+          'OC1CCCCC1', 'CC(C)Cc1ccc(cc1)C(C)C(=O)O', 'c1ccncc1', 'CCCCCC', 'F/C=C/F', 'F/C=C\\F']
+IDS = [f'CHEMBL{i}' for i in range(150)] + [f'ZINC{i}' for i in range(150)] + [f'MCULE-{i}' for i in range(100)]
+# A bond to an atom that doesn't exist: RDKit can't read the record
+BAD_RECORD = """BAD1
+     RDKit          2D
+
+  3  2  0  0  0  0  0  0  0  0999 V2000
+   -1.2990   -0.2500    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    0.0000    0.5000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    1.2990   -0.2500    0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0
+  1  2  1  0
+  2  9  1  0
+M  END
+>  <minimizedAffinity>  (1)
+-11.0
+
+>  <minimizedRMSD>  (1)
+0.5
+
+$$$$
+"""
+
+
+def write_sdf(path, n_records: int, seed: int):
+    """Pharmit-like results: repeated molecules and ids, scores and RMSDs on a coarse grid so that
+    some of them fall exactly on the thresholds"""
+    rng = random.Random(seed)
+    mols = []
+    for smiles in SMILES:
+        mol = Chem.MolFromSmiles(smiles)
+        AllChem.Compute2DCoords(mol)
+        mols.append(mol)
+    with open(path, 'w') as sdf:
+        for i in range(n_records):
+            if i == n_records // 2:
+                sdf.write(BAD_RECORD)
+            mol = Chem.Mol(rng.choice(mols))
+            mol.SetProp('_Name', ' '.join(rng.sample(IDS, rng.randint(1, 3))))
+            sdf.write(Chem.MolToMolBlock(mol))
+            sdf.write(f">  <minimizedAffinity>\n{rng.randrange(-48, -20) / 4}\n\n"
+                      f">  <minimizedRMSD>\n{rng.choice([0.5, 1.0, 1.5, 2.0, 2.5])}\n\n$$$$\n")
+
+
+@pytest.fixture(scope='module')
+def sdf_folder(tmp_path_factory):
+    """Folder with three minimized_results files, plain and gzipped"""
+    folder = tmp_path_factory.mktemp('sdfs')
+    for index, n_records in enumerate([400, 150, 300]):
+        path = folder / f'minimized_results{index}.sdf'
+        write_sdf(path, n_records, index)
+        with open(path, 'rb') as sdf, gzip.open(f'{path}.gz', 'wb') as sdf_gz:
+            sdf_gz.write(sdf.read())
+    return folder
+
+
+def get_sdf_files(sdf_folder, stream=False):
+    return sorted(glob.glob(str(sdf_folder / ('*.sdf.gz' if stream else '*.sdf'))))
+
+
+def read_baseline_records(sdf_files: list):
+    """(mol_ids, score, rmsd, smiles) of the records RDKit reads, parsed as the SdfProcessor did before
+    the sdf stage was optimized"""
+    RDLogger.DisableLog('rdApp.*')
+    records = []
+    for file in sdf_files:
+        if file.endswith('.gz'):
+            mol_supplier = Chem.ForwardSDMolSupplier(gzip.open(file), strictParsing=True, sanitize=False)
+        else:
+            mol_supplier = Chem.SDMolSupplier(file, strictParsing=True, sanitize=False)
+        for mol in mol_supplier:
+            if mol is None:
+                continue
+            records.append((mol.GetProp('_Name'), float(mol.GetProp('minimizedAffinity')),
+                            float(mol.GetProp('minimizedRMSD')), Chem.MolToSmiles(mol, isomericSmiles=False)))
+    RDLogger.EnableLog('rdApp.*')
+    return records
+
+
+def baseline_best_molecules(sdf_files: list, score: float, cli_rmsd: float):
+    """best_molecules_dict of the SdfProcessor before the sdf stage was optimized"""
+    best_molecules = {}
+    analyzed_mol = set()
+    smiles_found = set()
+    for mol_ids, mol_score, rmsd, smiles in read_baseline_records(sdf_files):
+        mol_ids_set = set(mol_ids.split(' '))
+        if mol_ids_set & analyzed_mol or not (mol_score < score and rmsd <= cli_rmsd) or smiles in smiles_found:
+            continue
+        best_molecules[mol_ids] = {'score': mol_score, 'rmsd': rmsd, 'smiles': smiles}
+        analyzed_mol |= mol_ids_set
+        smiles_found.add(smiles)
+    return best_molecules
+
+
+def new_processor(tmp_path, sdf_files: list, score: float = -8.0, cli_rmsd: float = 2.0, **kwargs):
+    os.makedirs(tmp_path / 'results', exist_ok=True)
+    sdfp = SdfProcessor(len(sdf_files), str(tmp_path), score=score, cli_rmsd=cli_rmsd, **kwargs)
+    sdfp.sdf_files = list(sdf_files)
+    return sdfp
+
+
+@pytest.fixture
+def small_shards(monkeypatch):
+    """Split the test files in several shards per file"""
+    monkeypatch.setattr(sdf_scanner, 'MIN_SHARD_SIZE', 8192)
+
+
+@pytest.mark.parametrize('options', [
+    {'use_cache': False},
+    {'use_cache': False, 'workers': 3},
+    {'use_cache': False, 'stream': True},
+    {'use_cache': False, 'stream': True, 'workers': 3},
+    {'use_cache': True},
+    {'use_cache': True, 'workers': 3},
+    {'use_cache': True, 'stream': True},
+])
+def test_every_path_selects_the_baseline_molecules(sdf_folder, tmp_path, small_shards, options):
+    sdf_files = get_sdf_files(sdf_folder, options.get('stream', False))
+    expected = baseline_best_molecules(get_sdf_files(sdf_folder), -8.0, 2.0)
+    assert len(expected) > 1
+    best_molecules = new_processor(tmp_path, sdf_files, **options).run_sdfprocessor()
+    assert list(best_molecules.items()) == list(expected.items())
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+@pytest.mark.parametrize('top_k', [1, 5, 1000])
+def test_top_k_keeps_the_best_baseline_molecules(sdf_folder, tmp_path, top_k, use_cache):
+    sdf_files = get_sdf_files(sdf_folder)
+    expected = baseline_best_molecules(sdf_files, -8.0, 2.0)
+    expected = sorted(expected.items(), key=lambda item: (item[1]['score'], item[1]['rmsd']))[:top_k]
+    best_molecules = new_processor(tmp_path, sdf_files, top_k=top_k, use_cache=use_cache).run_sdfprocessor()
+    assert list(best_molecules.items()) == expected
+
+
+def test_cached_hits_are_filtered_again(sdf_folder, tmp_path, small_shards, monkeypatch):
+    sdf_files = get_sdf_files(sdf_folder)
+    new_processor(tmp_path, sdf_files, workers=3).run_sdfprocessor()
+    # One row group per shard: the table is never built whole
+    assert pq.ParquetFile(get_cache_path(str(tmp_path))).num_row_groups > 3
+
+    def scan_again(*args):
+        raise AssertionError('The sdf files were scanned again')
+
+    monkeypatch.setattr(sdf_processor, 'scan_shard_hits', scan_again)
+    # A stricter threshold, then a looser one whose new hits are read from the sdf files by offset
+    for score, cli_rmsd in [(-8.0, 2.0), (-10.0, 1.0), (-6.0, 2.5), (-6.0, 2.5)]:
+        best_molecules = new_processor(tmp_path, sdf_files, score, cli_rmsd).run_sdfprocessor()
+        assert list(best_molecules.items()) == list(baseline_best_molecules(sdf_files, score, cli_rmsd).items())
+
+
+def brute_force_sweep(sdf_files: list, scores: list, rmsds: list):
+    """Unique SMILES of each cell of the grid, counted record by record"""
+    records = read_baseline_records(sdf_files)
+    rows = []
+    for database in ['all', *sorted({guess_database(record[0]) for record in records})]:
+        for score in scores:
+            row = {'database': database, 'score': f'< {score}'}
+            for cli_rmsd in rmsds:
+                row[f'RMSD <= {cli_rmsd}'] = len({smiles for mol_ids, mol_score, rmsd, smiles in records
+                                                  if mol_score < score and rmsd <= cli_rmsd and
+                                                  database in ('all', guess_database(mol_ids))})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_sweep_matches_a_brute_force_count(sdf_folder, tmp_path, use_cache):
+    sdf_files = get_sdf_files(sdf_folder)
+    scores, rmsds = [-11.0, -9.5, -8.0, -6.0], [0.5, 1.0, 2.0, 3.0]
+    sweep_df = new_processor(tmp_path, sdf_files, use_cache=use_cache).run_threshold_sweep(scores, rmsds)
+    pd.testing.assert_frame_equal(sweep_df, brute_force_sweep(sdf_files, scores, rmsds), check_dtype=False)
+    assert os.path.isfile(tmp_path / 'results' / 'threshold_sweep.csv')
+
+
+@pytest.mark.parametrize('use_cache, sweep, stream', [
+    (True, False, False),
+    (False, False, False),
+    (True, False, True),
+    (False, True, False),
+    (True, True, False),
+])
+def test_pipeline_selects_the_baseline_molecules(sdf_folder, tmp_path, monkeypatch, use_cache, sweep, stream):
+    """The downloads are moved to the run folder (and unzipped) while the pipeline may still be parsing them"""
+    downloads = tmp_path / 'downloads'
+    run_folder = tmp_path / 'run'
+    downloads.mkdir()
+    run_folder.mkdir()
+    monkeypatch.setattr(sdf_pipeline, 'get_download_list',
+                        lambda file_pattern: sorted(glob.glob(str(downloads / file_pattern))))
+    monkeypatch.setattr(sdf_processor, 'get_last_files',
+                        lambda file_pattern, minimize_count: sorted(glob.glob(str(downloads / file_pattern))))
+    pipeline = SdfPipeline(-8.0, 2.0, workers=2, use_cache=use_cache, sweep=sweep)
+    for sdf_gz in get_sdf_files(sdf_folder, stream=True):
+        shutil.copy(sdf_gz, tmp_path)
+        os.replace(tmp_path / os.path.basename(sdf_gz), downloads / os.path.basename(sdf_gz))
+    pipeline.start()
+    try:
+        sdfp = new_processor(run_folder, [], stream=stream, use_cache=use_cache, pipeline=pipeline)
+        sdfp.minimize_count = 3
+        sdfp.get_sdfs()
+        if sweep:
+            scores, rmsds = [-10.0, -8.0], [1.0, 2.0]
+            pd.testing.assert_frame_equal(sdfp.run_threshold_sweep(scores, rmsds),
+                                          brute_force_sweep(sdfp.sdf_files, scores, rmsds), check_dtype=False)
+        else:
+            best_molecules = sdfp.run_sdfprocessor()
+            assert list(best_molecules.items()) == list(baseline_best_molecules(sdfp.sdf_files, -8.0, 2.0).items())
+    finally:
+        pipeline.close()
+    assert not os.listdir(downloads)